@@ -1,8 +1,13 @@
 #!/usr/bin/env python
 
-import os, json, requests, sys, argparse, re
+import os, json, requests, sys, argparse, re, urllib, threading, time
 from datetime import datetime, timedelta
 from dateutil.relativedelta import relativedelta
+from multiprocessing.pool import ThreadPool
+from pagination import iterate_pagination_items, iterate_pagination_pages
+from http_cache import install_http_cache, DEFAULT_HTTP_CACHE_TTL_DAYS
+from state_store import load_state, save_state, Checkpoint
+from identity_directory import IdentityDirectory, GITHUB_SOURCE
 
 # Fill in GitHub Token
 GITHUB_API_TOKEN_NAME = 'GITHUB_API_TOKEN'
@@ -11,16 +16,28 @@ USER_AGENT= 'redhat-cop-stats'
 DEFAULT_START_DATE_MONTH = '03'
 DEFAULT_START_DATE_DAY = '01'
 UNLABELED = 'unlabeled'
-
-def handle_pagination_items(session, url):
-#    print "pagination called: {}".format(url)
-    pagination_request = session.get(url)
-    pagination_request.raise_for_status()
-
-    if 'next' in pagination_request.links and pagination_request.links['next']:
-        return pagination_request.json()['items'] + handle_pagination_items(session, pagination_request.links['next']['url'])
-    else:
-        return pagination_request.json()['items']
+DEFAULT_WORKERS = 8
+SEARCH_ISSUES_URL = 'https://api.github.com/search/issues'
+SEARCH_PER_PAGE = 100
+SEARCH_RESULT_LIMIT = 1000
+SEARCH_TIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+MAX_SEARCH_QUERY_LENGTH = 256
+DEFAULT_REPO_MATCHER = '.+'
+AUTHORED_PRS_QUERY = 'authored_prs'
+REVIEWED_PRS_QUERY = 'reviewed_prs'
+CLOSED_ISSUES_QUERY = 'closed_issues'
+CORE_RATE_LIMIT = 'core'
+SEARCH_RATE_LIMIT = 'search'
+RATE_LIMIT_LOW_WATER_RATIO = 0.1
+MAX_THROTTLE_RETRIES = 5
+SECONDARY_RATE_LIMIT_DELAY = 60
+SEARCH_COLLECTOR = 'search'
+REPOS_COLLECTOR = 'repos'
+REPO_PER_PAGE = 100
+SEARCH_INDEX_LAG = timedelta(hours=1)
+
+request_counts = {}
+request_counts_lock = threading.Lock()
 
 def generate_start_date():
     today_date = datetime.now()
@@ -46,11 +63,11 @@ def encode_text(text):
 
 def get_org_repos(session, github_org):
     
-    return handle_pagination_items(session, "https://api.github.com/orgs/{0}/repos".format(github_org))
+    return iterate_pagination_items(session, "https://api.github.com/orgs/{0}/repos?per_page=100".format(github_org))
 
 def get_org_members(session, github_org):
 
-    return handle_pagination_items(session, "https://api.github.com/orgs/{0}/members".format(github_org))
+    return iterate_pagination_items(session, "https://api.github.com/orgs/{0}/members".format(github_org))
 
 def get_pr(session, url):
     pr_request = session.get(url)
@@ -64,10 +81,407 @@ def get_reviews(session, url):
 
     return pr_request.json()
 
-def get_org_search_issues(session, start_date, github_org):
+def count_request(response, *args, **kwargs):
+    path = response.request.path_url
+
+    if path.startswith('/search/'):
+        request_type = 'search'
+    elif path.split('?')[0].endswith('/reviews'):
+        request_type = 'reviews'
+    else:
+        request_type = 'other'
+
+    with request_counts_lock:
+        request_counts[request_type] = request_counts.get(request_type, 0) + 1
+
+class RateLimitedSession(requests.Session):
+    """Session that schedules requests against the core and search rate limit budgets"""
+
+    def __init__(self, workers):
+        super(RateLimitedSession, self).__init__()
+        self.workers = workers
+        self.rate_limit_condition = threading.Condition()
+        self.rate_limits = {}
+
+        for resource in [CORE_RATE_LIMIT, SEARCH_RATE_LIMIT]:
+            self.rate_limits[resource] = {'limit': None, 'remaining': None, 'reset': None, 'reported_reset': None, 'in_flight': 0, 'requests': 0}
+
+    def allowed_in_flight(self, rate_limit):
+        if rate_limit['remaining'] is None:
+            return self.workers
+
+        # Use full concurrency until the budget runs low, then scale down to a single request at a time
+        low_water_mark = rate_limit['limit'] * RATE_LIMIT_LOW_WATER_RATIO
+
+        if rate_limit['remaining'] >= low_water_mark:
+            return self.workers
+
+        return max(1, min(self.workers, int(self.workers * rate_limit['remaining'] / low_water_mark)))
+
+    def acquire(self, resource):
+        rate_limit = self.rate_limits[resource]
+
+        with self.rate_limit_condition:
+            while True:
+                now = time.time()
+
+                if rate_limit['reset'] is not None and rate_limit['reset'] <= now:
+                    # The budget has been replenished, the next response reports the new values
+                    rate_limit['remaining'] = None
+                    rate_limit['reset'] = None
+
+                if rate_limit['remaining'] is not None and rate_limit['remaining'] - rate_limit['in_flight'] <= 0:
+                    if rate_limit['reported_reset'] != rate_limit['reset']:
+                        rate_limit['reported_reset'] = rate_limit['reset']
+                        print >> sys.stderr, "Rate limit for '{0}' exhausted, waiting {1:.0f} seconds for reset".format(resource, rate_limit['reset'] - now)
+                    self.rate_limit_condition.wait(rate_limit['reset'] - now + 1)
+                    continue
+
+                if rate_limit['in_flight'] >= self.allowed_in_flight(rate_limit):
+                    self.rate_limit_condition.wait()
+                    continue
+
+                break
+
+            rate_limit['in_flight'] += 1
+
+    def release(self, resource, response):
+        with self.rate_limit_condition:
+            self.rate_limits[resource]['in_flight'] -= 1
+
+            if response is not None and 'X-RateLimit-Remaining' in response.headers:
+                rate_limit = self.rate_limits[response.headers.get('X-RateLimit-Resource', resource)]
+                rate_limit['limit'] = int(response.headers['X-RateLimit-Limit'])
+                rate_limit['remaining'] = int(response.headers['X-RateLimit-Remaining'])
+                rate_limit['reset'] = int(response.headers['X-RateLimit-Reset'])
+                rate_limit['requests'] += 1
+
+            self.rate_limit_condition.notify_all()
+
+    def throttle_delay(self, response, attempt):
+        if response.status_code not in [403, 429]:
+            return None
+
+        if 'Retry-After' in response.headers:
+            return int(response.headers['Retry-After'])
+
+        if response.headers.get('X-RateLimit-Remaining') == '0':
+            return max(0, int(response.headers['X-RateLimit-Reset']) - time.time()) + 1
+
+        # Secondary rate limits do not always include a Retry-After header
+        if 'rate limit' in response.text.lower():
+            return SECONDARY_RATE_LIMIT_DELAY * (attempt + 1)
+
+        return None
+
+    def request(self, method, url, *args, **kwargs):
+        resource = SEARCH_RATE_LIMIT if '/search/' in url else CORE_RATE_LIMIT
+
+        for attempt in range(MAX_THROTTLE_RETRIES + 1):
+            response = None
+            self.acquire(resource)
+            try:
+                response = super(RateLimitedSession, self).request(method, url, *args, **kwargs)
+            finally:
+                self.release(resource, response)
+
+            delay = self.throttle_delay(response, attempt)
+
+            if delay is None or attempt == MAX_THROTTLE_RETRIES:
+                return response
+
+            print >> sys.stderr, "Request to {0} was throttled, retrying in {1:.0f} seconds".format(url, delay)
+            time.sleep(delay)
+
+    def rate_limit_usage(self):
+        usage = []
+
+        for resource in [CORE_RATE_LIMIT, SEARCH_RATE_LIMIT]:
+            rate_limit = self.rate_limits[resource]
+
+            if rate_limit['limit'] is not None:
+                usage.append("{0}={1} requests, {2} of {3} remaining".format(resource, rate_limit['requests'], rate_limit['remaining'], rate_limit['limit']))
+
+        return ", ".join(usage)
+
+def get_pr_review_logins(session, issue, checkpoint):
+    review_logins = checkpoint.get('reviews', str(issue['id']))
+
+    if review_logins is None:
+        review_logins = [review['user']['login'] for review in get_reviews(session, issue['pull_request']['url'])]
+        checkpoint.set('reviews', str(issue['id']), review_logins)
+
+    return review_logins
+
+def get_pr_reviews(session, pr_issues, workers, checkpoint):
+    pool = ThreadPool(workers)
+    try:
+        # map() returns results in input order, so completion order does not leak into the output
+        pr_reviews = pool.map(lambda issue: get_pr_review_logins(session, issue, checkpoint), pr_issues)
+    finally:
+        pool.close()
+        pool.join()
+
+    return dict(zip([issue['id'] for issue in pr_issues], pr_reviews))
+
+def plan_label_qualifiers(input_labels):
+    included_labels = sorted([key for key in input_labels if key[-1] != "-"])
+    omitted_labels = sorted([key[0:-1] for key in input_labels if key[-1] == "-"])
+
+    # Omitted labels only hide their own bucket, a PR carrying another label is still credited under it,
+    # so they are always left to show_label. Mixed filters and the unlabeled bucket (other than on its own) as well.
+    if omitted_labels:
+        return ""
+
+    if included_labels == [UNLABELED]:
+        return "no:label"
+
+    if UNLABELED in included_labels:
+        return ""
+
+    return "label:{0}".format(",".join(['"{0}"'.format(label) for label in included_labels]))
+
+def partition_org_repos(session, github_org, repo_matcher, repo_excluder):
+    included_repos = []
+    excluded_repos = []
+
+    for repo in get_org_repos(session, github_org):
+        if repo['archived']:
+            continue
+
+        if repo_name_is_included(repo['name'], repo_matcher, repo_excluder):
+            included_repos.append(repo['full_name'])
+        else:
+            excluded_repos.append(repo['full_name'])
+
+    return sorted(included_repos), sorted(excluded_repos)
+
+def plan_repo_qualifiers(session, github_org, repo_matcher, repo_excluder):
+    org_qualifier = "user:{0}".format(github_org)
+
+    if repo_matcher == DEFAULT_REPO_MATCHER and repo_excluder is None:
+        return org_qualifier
+
+    # Evaluate the regexes against the repo list so they can be expressed as repo: qualifiers
+    included_repos, excluded_repos = partition_org_repos(session, github_org, repo_matcher, repo_excluder)
+
+    if not included_repos:
+        return None
+
+    included_qualifiers = " ".join(["repo:{0}".format(repo) for repo in included_repos])
+    excluded_qualifiers = " ".join([org_qualifier] + ["-repo:{0}".format(repo) for repo in excluded_repos])
+
+    return min(included_qualifiers, excluded_qualifiers, key=len)
+
+def plan_search_queries(github_org, username, input_labels, repo_qualifiers):
+    base_qualifiers = "{0} archived:false".format(repo_qualifiers)
+
+    # Merge status is part of the query so no per-PR detail request is needed to check merged_at
+    merged_prs_query = "is:pr is:merged {0}".format(base_qualifiers)
+    closed_issues_query = "is:issue is:closed {0}".format(base_qualifiers)
+
+    if username is None:
+        # A single PR search feeds both the general and the reviewed PRs, so labels can not be pushed down
+        return {
+            AUTHORED_PRS_QUERY: merged_prs_query,
+            REVIEWED_PRS_QUERY: merged_prs_query,
+            CLOSED_ISSUES_QUERY: closed_issues_query
+        }
+
+    return {
+        AUTHORED_PRS_QUERY: " ".join(filter(None, [merged_prs_query, "author:{0}".format(username), plan_label_qualifiers(input_labels)])),
+        REVIEWED_PRS_QUERY: "{0} reviewed-by:{1}".format(merged_prs_query, username),
+        CLOSED_ISSUES_QUERY: "{0} assignee:{1}".format(closed_issues_query, username)
+    }
+
+def search_window_qualifier(window):
+    # The most recent window is left open ended so its URLs, and thus cached responses, are stable between runs
+    window_end = window[1].strftime(SEARCH_TIME_FORMAT) if window[1] is not None else "*"
+    return "updated:{0}..{1}".format(window[0].strftime(SEARCH_TIME_FORMAT), window_end)
+
+def build_search_url(query, window, per_page=SEARCH_PER_PAGE):
+    windowed_query = "{0} {1}".format(query, search_window_qualifier(window))
+    return "{0}?q={1}&per_page={2}".format(SEARCH_ISSUES_URL, urllib.quote_plus(windowed_query, safe=':'), per_page)
+
+def get_search_first_page(session, query, window):
+    first_page_request = session.get(build_search_url(query, window))
+    first_page_request.raise_for_status()
+
+    next_link = first_page_request.links.get('next')
+
+    return first_page_request.json(), next_link['url'] if next_link else None
+
+def plan_search_windows(pool, session, query, start_date, checkpoint):
+    search_windows = []
+    pending_windows = [(start_date, None)]
+
+    # Bisect every window whose results would be truncated by the search result cap. The first page of
+    # each window doubles as the probe for its total count, and is kept as the progress of the window.
+    while pending_windows:
+        first_pages = pool.map(lambda window: get_search_first_page(session, query, window), pending_windows)
+        split_windows = []
+
+        for window, (first_page, next_url) in zip(pending_windows, first_pages):
+            total_count = first_page['total_count']
+
+            window_end = window[1] if window[1] is not None else datetime.utcnow().replace(microsecond=0)
+
+            if total_count > SEARCH_RESULT_LIMIT and window_end - window[0] > timedelta(seconds=1):
+                window_middle = window[0] + (window_end - window[0]) / 2
+                split_windows.extend([(window[0], window_middle), (window_middle, window[1])])
+                continue
+
+            if total_count > SEARCH_RESULT_LIMIT:
+                print >> sys.stderr, "Warning: {0} results updated at {1} exceed the search limit and will be truncated".format(total_count, window[0].strftime(SEARCH_TIME_FORMAT))
+
+            if total_count > 0:
+                search_windows.append(window)
+                checkpoint.set('search_pages', build_search_url(query, window), {'next': next_url, 'items': [trim_issue(issue) for issue in first_page['items']]})
+
+        pending_windows = split_windows
+
+    return sorted(search_windows)
+
+def get_search_window_issues(session, query, window, checkpoint):
+    url = build_search_url(query, window)
+    progress = checkpoint.get('search_pages', url, {'next': url, 'items': []})
+    issues = progress['items']
+
+    if progress['next']:
+        for page_issues, next_url in iterate_pagination_pages(session, progress['next'], 'items'):
+            issues.extend([trim_issue(issue) for issue in page_issues])
+            checkpoint.set('search_pages', url, {'next': next_url, 'items': issues})
+
+    return issues
+
+def get_search_windows(pool, session, query, start_date, checkpoint):
+    search_windows = checkpoint.get('search_windows', query)
 
-    query = "https://api.github.com/search/issues?q=user:{}+updated:>={}+archived:false+state:closed&per_page=200".format(github_org, start_date.date().isoformat())
-    return handle_pagination_items(session, query)
+    # Reuse the windows of a resumed run, as split points depend on the time the search was planned
+    if search_windows is not None:
+        return [(datetime.strptime(window[0], SEARCH_TIME_FORMAT), datetime.strptime(window[1], SEARCH_TIME_FORMAT) if window[1] else None) for window in search_windows]
+
+    search_windows = plan_search_windows(pool, session, query, start_date, checkpoint)
+    checkpoint.set('search_windows', query, [(window[0].strftime(SEARCH_TIME_FORMAT), window[1].strftime(SEARCH_TIME_FORMAT) if window[1] else None) for window in search_windows])
+
+    return search_windows
+
+def get_sharded_search_issues(session, query, start_date, workers, checkpoint):
+    pool = ThreadPool(workers)
+    try:
+        search_windows = get_search_windows(pool, session, query, start_date, checkpoint)
+        window_issues = pool.map(lambda window: get_search_window_issues(session, query, window, checkpoint), search_windows)
+    finally:
+        pool.close()
+        pool.join()
+
+    # The ranges are inclusive at both ends, so items updated on a window boundary are returned twice
+    issues = []
+    issue_ids = set()
+
+    for window_issue in window_issues:
+        for issue in window_issue:
+            if issue['id'] not in issue_ids:
+                issue_ids.add(issue['id'])
+                issues.append(issue)
+
+    return issues
+
+def get_repo_merged_pr_numbers(session, repo, start_date):
+    merged_pr_numbers = set()
+    updated_after = start_date.strftime(SEARCH_TIME_FORMAT)
+
+    url = "https://api.github.com/repos/{0}/pulls?state=closed&sort=updated&direction=desc&per_page={1}".format(repo, REPO_PER_PAGE)
+
+    # Results are sorted by most recently updated, so stop at the first PR older than the start date
+    for pr in iterate_pagination_items(session, url):
+        if pr['updated_at'] < updated_after:
+            break
+
+        if pr['merged_at']:
+            merged_pr_numbers.add(pr['number'])
+
+    return merged_pr_numbers
+
+def get_repo_closed_issues(session, repo, start_date):
+    updated_after = start_date.strftime(SEARCH_TIME_FORMAT)
+
+    url = "https://api.github.com/repos/{0}/issues?state=closed&sort=updated&direction=desc&since={1}&per_page={2}".format(repo, updated_after, REPO_PER_PAGE)
+
+    for issue in iterate_pagination_items(session, url):
+        if issue['updated_at'] < updated_after:
+            break
+
+        yield issue
+
+def get_repo_issues(session, repo, start_date, checkpoint):
+    repo_issues = checkpoint.get('repos', repo)
+
+    if repo_issues is not None:
+        return repo_issues
+
+    merged_pr_numbers = get_repo_merged_pr_numbers(session, repo, start_date)
+
+    merged_pr_issues = []
+    closed_issue_items = []
+
+    # The issues endpoint also lists PRs, in the same shape as the search results
+    for issue in get_repo_closed_issues(session, repo, start_date):
+        if 'pull_request' not in issue:
+            closed_issue_items.append(trim_issue(issue))
+        elif issue['number'] in merged_pr_numbers:
+            merged_pr_issues.append(trim_issue(issue))
+
+    checkpoint.set('repos', repo, [merged_pr_issues, closed_issue_items])
+
+    return merged_pr_issues, closed_issue_items
+
+def get_org_repo_issues(session, repos, start_date, workers, checkpoint):
+    pool = ThreadPool(workers)
+    try:
+        repo_issues = pool.map(lambda repo: get_repo_issues(session, repo, start_date, checkpoint), repos)
+    finally:
+        pool.close()
+        pool.join()
+
+    merged_pr_issues = []
+    closed_issue_items = []
+
+    for repo_merged_pr_issues, repo_closed_issue_items in repo_issues:
+        merged_pr_issues.extend(repo_merged_pr_issues)
+        closed_issue_items.extend(repo_closed_issue_items)
+
+    return merged_pr_issues, closed_issue_items
+
+def trim_issue(issue):
+    # Keep only the fields used to aggregate and report, so the state file stays small
+    trimmed_issue = {
+        'id': issue['id'],
+        'number': issue['number'],
+        'title': issue['title'],
+        'state': issue['state'],
+        'updated_at': issue['updated_at'],
+        'repository_url': issue['repository_url'],
+        'labels': [{'name': label['name']} for label in issue['labels']],
+        'user': {'id': issue['user']['id'], 'login': issue['user']['login']},
+        'assignee': {'id': issue['assignee']['id'], 'login': issue['assignee']['login']} if issue['assignee'] else None
+    }
+
+    if 'pull_request' in issue:
+        trimmed_issue['pull_request'] = {'url': issue['pull_request']['url']}
+
+    return trimmed_issue
+
+def merge_state_issues(state_issues, issues):
+    # Issue ids are stored as strings as they are used as JSON object keys
+    for issue in issues:
+        state_issues[str(issue['id'])] = trim_issue(issue)
+
+    return sort_issues(state_issues.values())
+
+def sort_issues(issues):
+    # Most recently updated first, so the item reported first does not depend on how the items were collected
+    return sorted(issues, key=lambda issue: (issue['updated_at'], issue['id']), reverse=True)
 
 def process_labels(labels):
     label_dict = {}
@@ -114,8 +528,7 @@ def show_label(label_items_key, input_labels):
 
     return False
 
-def repo_is_included(issue, repo_matcher, repo_excluder):
-    repo_name = issue['repository_url'].split('/')[-1]
+def repo_name_is_included(repo_name, repo_matcher, repo_excluder):
     repo_name_matches = True if re.match(repo_matcher, repo_name) != None else False
     repo_name_excluded = True if None != repo_excluder and re.match(repo_excluder, repo_name) != None else False
     #print "{0} - matches? {1}, excluded? {2}".format(repo_name, repo_name_matches, repo_name_excluded)
@@ -123,22 +536,38 @@ def repo_is_included(issue, repo_matcher, repo_excluder):
         return True
     return False;
 
+def repo_is_included(issue, repo_matcher, repo_excluder):
+    return repo_name_is_included(issue['repository_url'].split('/')[-1], repo_matcher, repo_excluder)
+
 parser = argparse.ArgumentParser(description='Gather GitHub Statistics.')
 parser.add_argument("-s","--start-date", help="The start date to query from", type=valid_date)
 parser.add_argument("-r","--human-readable", action="store_true", help="Human readable format")
 parser.add_argument("-u","--username", help="Username to query")
 parser.add_argument("-l","--labels", help="Comma separated list to display. Add '-' at end of each label to negate")
 parser.add_argument("-o","--organization", help="Organization name", default=GITHUB_ORG_DEFAULT)
-parser.add_argument("-m","--repo-matcher", help="Repo Matcher", default=".+")
+parser.add_argument("-m","--repo-matcher", help="Repo Matcher", default=DEFAULT_REPO_MATCHER)
 parser.add_argument("-x","--repo-excluder", help="Repo Excluder")
+parser.add_argument("-c","--collector", help="Collect through the search API or by walking each repository", choices=[SEARCH_COLLECTOR, REPOS_COLLECTOR], default=SEARCH_COLLECTOR)
+parser.add_argument("-w","--workers", help="Maximum number of requests in flight when searching windows, walking repositories and retrieving PR reviews", type=int, default=DEFAULT_WORKERS)
+parser.add_argument("--state-file", help="JSON file used to only collect items updated since the previous run")
+parser.add_argument("--checkpoint-file", help="JSON file used to periodically save the progress of the run")
+parser.add_argument("--resume", action="store_true", help="Resume from the progress saved in the checkpoint file")
+parser.add_argument("--identity-directory", help="SQLite file in which the logins of the contributors are recorded")
+parser.add_argument("--http-cache", help="SQLite file used to cache responses between runs")
+parser.add_argument("--http-cache-ttl", help="Days before an unvalidated cached response expires", type=int, default=DEFAULT_HTTP_CACHE_TTL_DAYS)
 args = parser.parse_args()
 
+if args.resume and not args.checkpoint_file:
+    parser.error("--resume requires --checkpoint-file")
+
 start_date = args.start_date
 username = args.username
 input_labels = args.labels
 repo_matcher = args.repo_matcher
 repo_excluder = args.repo_excluder
 github_org = args.organization
+collector = args.collector
+workers = max(1, args.workers)
 
 human_readable=(args.human_readable==True)
 
@@ -152,13 +581,21 @@ if not github_api_token:
     print "Error: GitHub API Key is Required!"
     sys.exit(1)
 
-session = requests.Session()
+session = RateLimitedSession(workers)
 session.headers = {
     'Accept': 'application/vnd.github.v3+json',
     'Authorization': 'Token {0}'.format(github_api_token),
     'User-Agent': USER_AGENT
 }
 
+# Size the connection pool to match the number of concurrent workers
+if args.http_cache:
+    http_cache = install_http_cache(session, args.http_cache, args.http_cache_ttl, pool_connections=workers, pool_maxsize=workers)
+else:
+    http_cache = None
+    session.mount('https://', requests.adapters.HTTPAdapter(pool_connections=workers, pool_maxsize=workers))
+session.hooks['response'].append(count_request)
+
 # Produce Label String
 input_labels = process_labels(args.labels)
 
@@ -167,97 +604,172 @@ general_prs = {}
 closed_issues = {}
 reviewed_prs = {}
 
-org_search_issues = get_org_search_issues(session, start_date, github_org)
+state_signature = {
+    'organization': github_org,
+    'start_date': start_date.strftime(SEARCH_TIME_FORMAT),
+    'username': username,
+    'labels': sorted(input_labels.keys()),
+    'repo_matcher': repo_matcher,
+    'repo_excluder': repo_excluder,
+    'collector': collector
+}
 
-for issue in org_search_issues:
+collect_since = start_date
+state = load_state(args.state_file)
 
-    if not repo_is_included(issue, repo_matcher, repo_excluder):
-        continue
+if state is not None and state['signature'] == state_signature:
+    # Only collect items updated since the previous run, allowing for the search index to catch up
+    collect_since = max(start_date, datetime.strptime(state['watermark'], SEARCH_TIME_FORMAT) - SEARCH_INDEX_LAG)
+else:
+    state = {'signature': state_signature, 'watermark': None, 'reviewed_prs': {}, 'reviews': {}, 'merged_prs': {}, 'closed_issues': {}}
 
-#    print "{}:".format(issue['id'])
-    issue_author_id = issue['user']['id']
-    issue_author_login = issue['user']['login']
+run_started_at = datetime.utcnow().replace(microsecond=0)
 
-    # Check if Issue is a Pull Request
-    if 'pull_request' in issue:
-        is_pull_request = True
+checkpoint = Checkpoint(args.checkpoint_file, dict(state_signature, collect_since=collect_since.strftime(SEARCH_TIME_FORMAT)), args.resume)
 
-        pr_url = issue['pull_request']['url']
+if checkpoint.resumed:
+    print >> sys.stderr, "Resuming from checkpoint '{0}'".format(args.checkpoint_file)
 
-        pr = get_pr(session, pr_url)
+    # Keep the watermark of the interrupted run, as only the items updated since then have been collected
+    run_started_at = datetime.strptime(checkpoint.get('run', 'started_at'), SEARCH_TIME_FORMAT)
 
-        # Check if PR Has Been Merged
-        if not pr['merged_at']:
-            continue
+checkpoint.set('run', 'started_at', run_started_at.strftime(SEARCH_TIME_FORMAT))
 
-        # Check for Reviews
-        pr_reviews = get_reviews(session, pr_url)
+if collector == REPOS_COLLECTOR:
+    # Walk the PRs and issues of every repo instead of using the rate limited and capped search API
+    included_repos, excluded_repos = partition_org_repos(session, github_org, repo_matcher, repo_excluder)
+    merged_pr_issues, closed_issue_items = get_org_repo_issues(session, included_repos, collect_since, workers, checkpoint)
+    reviewed_pr_issues = merged_pr_issues
+else:
+    repo_qualifiers = plan_repo_qualifiers(session, github_org, repo_matcher, repo_excluder)
 
-        for review in pr_reviews:
-            review_author_login = review['user']['login']
+    if repo_qualifiers is None:
+        search_queries = {}
+    else:
+        search_queries = plan_search_queries(github_org, username, input_labels, repo_qualifiers)
 
-            #Filter out unwanted review users
-            if username is not None and review_author_login != username:
-                continue
+        # Fall back to filtering repos client side when the qualifiers do not fit in a search query
+        if max([len(query) for query in search_queries.values()]) + len(search_window_qualifier((start_date, start_date))) >= MAX_SEARCH_QUERY_LENGTH:
+            search_queries = plan_search_queries(github_org, username, input_labels, "user:{0}".format(github_org))
 
-            if review_author_login not in reviewed_prs:
-                review_author_prs = {}
-            else:
-                review_author_prs = reviewed_prs[review_author_login]
-            
-            if issue['id'] not in review_author_prs:
-                review_author_prs[issue['id']] = issue
-            
-            reviewed_prs[review_author_login] = review_author_prs
-
-        #Filter out unwanted pr users
-        if username is not None and issue_author_login != username:
-            continue
+    # Identical queries are only issued once
+    search_results = {}
+    for query in sorted(set(search_queries.values())):
+        search_results[query] = [issue for issue in get_sharded_search_issues(session, query, collect_since, workers, checkpoint) if repo_is_included(issue, repo_matcher, repo_excluder)]
 
-        # Check if Label exists
-        if issue['labels']:
-            for label in issue['labels']:
-                
-                label_name = label['name']
+    reviewed_pr_issues = search_results.get(search_queries.get(REVIEWED_PRS_QUERY), [])
+    merged_pr_issues = search_results.get(search_queries.get(AUTHORED_PRS_QUERY), [])
+    closed_issue_items = search_results.get(search_queries.get(CLOSED_ISSUES_QUERY), [])
 
-                # Determine if Label Exists
-                if label_name not in general_prs:
-                    label_issues = {}
-                else:
-                    label_issues = general_prs[label_name]
-                
-                general_prs[label_name] = process_general_issues(issue,general_prs, label_issues)
+if collector == SEARCH_COLLECTOR and username is not None:
+    # The reviewed-by qualifier already establishes that the user reviewed each PR
+    pr_review_logins = dict([(issue['id'], [username]) for issue in reviewed_pr_issues])
+else:
+    # Resolve reviews concurrently before aggregating
+    pr_review_logins = get_pr_reviews(session, reviewed_pr_issues, workers, checkpoint)
+
+reviewed_pr_issues = sort_issues(reviewed_pr_issues)
+merged_pr_issues = sort_issues(merged_pr_issues)
+closed_issue_items = sort_issues(closed_issue_items)
+
+fetched_issue_count = len(set([issue['id'] for issue in merged_pr_issues + reviewed_pr_issues]))
+
+if args.state_file:
+    # Merge the items updated since the previous run into the stored aggregate
+    for issue_id, review_logins in pr_review_logins.iteritems():
+        state['reviews'][str(issue_id)] = review_logins
+
+    reviewed_pr_issues = merge_state_issues(state['reviewed_prs'], reviewed_pr_issues)
+    merged_pr_issues = merge_state_issues(state['merged_prs'], merged_pr_issues)
+    closed_issue_items = merge_state_issues(state['closed_issues'], closed_issue_items)
+    pr_review_logins = dict([(int(issue_id), review_logins) for issue_id, review_logins in state['reviews'].iteritems()])
+
+for issue in reviewed_pr_issues:
 
+    for review_author_login in pr_review_logins[issue['id']]:
+
+        #Filter out unwanted review users
+        if username is not None and review_author_login != username:
+            continue
+
+        if review_author_login not in reviewed_prs:
+            review_author_prs = {}
         else:
-            if UNLABELED not in general_prs:
+            review_author_prs = reviewed_prs[review_author_login]
+
+        if issue['id'] not in review_author_prs:
+            review_author_prs[issue['id']] = issue
+
+        reviewed_prs[review_author_login] = review_author_prs
+
+for issue in merged_pr_issues:
+
+    issue_author_login = issue['user']['login']
+
+    #Filter out unwanted pr users
+    if username is not None and issue_author_login != username:
+        continue
+
+    # Check if Label exists
+    if issue['labels']:
+        for label in issue['labels']:
+
+            label_name = label['name']
+
+            # Determine if Label Exists
+            if label_name not in general_prs:
                 label_issues = {}
             else:
-                label_issues = general_prs[UNLABELED]
+                label_issues = general_prs[label_name]
 
-            general_prs[UNLABELED] = process_general_issues(issue,general_prs, label_issues)
+            general_prs[label_name] = process_general_issues(issue,general_prs, label_issues)
 
     else:
+        if UNLABELED not in general_prs:
+            label_issues = {}
+        else:
+            label_issues = general_prs[UNLABELED]
 
-        if issue['state'] == 'closed' and issue['assignee'] is not None:
+        general_prs[UNLABELED] = process_general_issues(issue,general_prs, label_issues)
 
-            closed_issue_author_id = issue['assignee']['id']
-            closed_issue_author_login = issue['assignee']['login']
+for issue in closed_issue_items:
 
-            #Filter out unwanted assignees
-            if username is not None and closed_issue_author_login != username:
-                continue
+    issue_author_id = issue['user']['id']
 
-            # Ignore Self Assigned Issues
-            if issue_author_id == closed_issue_author_id:
-                continue
+    if issue['state'] == 'closed' and issue['assignee'] is not None:
 
-            if closed_issue_author_id not in closed_issues:
-                closed_issue_author = []
-            else:
-                closed_issue_author = closed_issues[closed_issue_author_id]
-            
-            closed_issue_author.append(issue)
-            closed_issues[closed_issue_author_id] = closed_issue_author 
+        closed_issue_author_id = issue['assignee']['id']
+        closed_issue_author_login = issue['assignee']['login']
+
+        #Filter out unwanted assignees
+        if username is not None and closed_issue_author_login != username:
+            continue
+
+        # Ignore Self Assigned Issues
+        if issue_author_id == closed_issue_author_id:
+            continue
+
+        if closed_issue_author_id not in closed_issues:
+            closed_issue_author = []
+        else:
+            closed_issue_author = closed_issues[closed_issue_author_id]
+
+        closed_issue_author.append(issue)
+        closed_issues[closed_issue_author_id] = closed_issue_author
+
+# Record the contributors so their points can be joined with the other collectors
+if args.identity_directory:
+    identity_directory = IdentityDirectory(args.identity_directory)
+    contributor_logins = set([issue['user']['login'] for issue in merged_pr_issues] + reviewed_prs.keys() + [value[0]['assignee']['login'] for value in closed_issues.values()])
+
+    for login in sorted(contributor_logins):
+        identity_directory.record(GITHUB_SOURCE, login, login)
+
+if args.state_file:
+    state['watermark'] = run_started_at.strftime(SEARCH_TIME_FORMAT)
+    save_state(args.state_file, state)
+
+checkpoint.complete()
 
 print "=== Statistics for GitHub Organization '{0}' ====".format(github_org)      
 
@@ -296,3 +808,9 @@ for key, value in closed_issues.iteritems():
         for issue_value in value:
             print "   {0} - {1}".format(encode_text(value['repository_url'].split('/')[-1]), encode_text(value[0]['title']))
 
+# Every merged PR returned by the typed search would previously have required a get_pr request to check merged_at
+print >> sys.stderr, "\nRequests: search={0}, reviews={1}, other={2} (at least {3} PR detail requests avoided)".format(request_counts.get('search', 0), request_counts.get('reviews', 0), request_counts.get('other', 0), fetched_issue_count)
+print >> sys.stderr, "Rate limit usage: {0}".format(session.rate_limit_usage())
+
+if http_cache is not None:
+    print >> sys.stderr, "HTTP cache: {0}".format(http_cache.cache_usage())
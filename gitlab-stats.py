@@ -8,9 +8,19 @@ import pytz
 import argparse
 import dateutil.parser
 import urllib
+import urlparse
 import re
+import time
+import threading
+import Queue
 from datetime import datetime, timedelta
 from dateutil.relativedelta import relativedelta
+from itertools import izip
+from multiprocessing.pool import ThreadPool
+from pagination import iterate_pagination_items, iterate_pagination_pages
+from state_store import load_state, save_state, Checkpoint
+from identity_directory import IdentityDirectory, GITLAB_SOURCE
+from http_cache import install_http_cache, DEFAULT_HTTP_CACHE_TTL_DAYS
 
 # Fill in GitHub Token
 GITLAB_API_TOKEN_NAME = 'GITLAB_API_TOKEN'
@@ -20,12 +30,25 @@ GITLAB_SERVER_DEFAULT = 'https://gitlab.consulting.redhat.com'
 GITLAB_GROUP_DEFAULT = 'redhat-cop'
 DEFAULT_START_DATE_MONTH = '03'
 DEFAULT_START_DATE_DAY = '01'
+DEFAULT_PROJECT_INDEX_TTL_HOURS = 24
+DEFAULT_WORKERS = 8
+GITLAB_PER_PAGE = 100
+GROUP_DATA_TYPES = ['merge_requests', 'issues']
+DEFAULT_REPO_MATCHER = '.+'
+MAX_PROJECT_ENDPOINTS = 20
+REVIEWERS_MERGED_BY = 'merged-by'
+REVIEWERS_APPROVALS = 'approvals'
+ITEM_QUEUE_SIZE = 1000
 merged_mrs = {}
 closed_issues = {}
 reviewed_mrs = {}
-project_cache = {}
+project_index = {}
+merge_request_reviewers = {}
+checkpoint = None
 
 is_debug = False
+workers = DEFAULT_WORKERS
+reviewer_mode = REVIEWERS_MERGED_BY
 
 
 def encode_text(text):
@@ -53,16 +76,78 @@ def valid_date(s):
         raise argparse.ArgumentTypeError(msg)
 
 
-def handle_pagination_items(session, url):
+def set_query_params(url, params, removed_params=[]):
+    url_parts = urlparse.urlparse(url)
+    query_params = [(key, value) for key, value in urlparse.parse_qsl(url_parts.query) if key not in params and key not in removed_params]
+    query_params.extend(sorted(params.items()))
+
+    return urlparse.urlunparse(url_parts._replace(query=urllib.urlencode(query_params)))
+
+def get_gitlab_page(session, url):
     if is_debug:
-        print "DEBUG:: handle_pagination_items(): url = {0}".format(url)
-    pagination_request = session.get(url)
-    pagination_request.raise_for_status()
+        print "DEBUG:: get_gitlab_page(): url = {0}".format(url)
 
-    if 'next' in pagination_request.headers["Link"] and pagination_request.links['next']:
-        return pagination_request.json() + handle_pagination_items(session, pagination_request.links['next']['url'])
-    else:
-        return pagination_request.json()
+    page_request = session.get(url)
+    page_request.raise_for_status()
+
+    return page_request
+
+def iterate_gitlab_pages(session, url, keyset_order_by=None):
+    # Pages are yielded in order together with the URL of the following page,
+    # which can be recorded as a cursor to resume from
+    first_page_request = get_gitlab_page(session, url)
+    first_page_items = first_page_request.json()
+
+    if first_page_request.headers.get('X-Total-Pages'):
+        # The number of pages is known, so request the remaining pages concurrently
+        current_page = int(first_page_request.headers.get('X-Page', 1))
+        total_pages = int(first_page_request.headers['X-Total-Pages'])
+        remaining_pages = range(current_page + 1, total_pages + 1)
+
+        def page_cursor(page):
+            return set_query_params(url, {'page': page + 1}) if page < total_pages else None
+
+        yield first_page_items, page_cursor(current_page)
+
+        pool = ThreadPool(workers)
+        try:
+            page_requests = pool.imap(lambda page: get_gitlab_page(session, set_query_params(url, {'page': page})), remaining_pages)
+
+            for page, page_request in izip(remaining_pages, page_requests):
+                yield page_request.json(), page_cursor(page)
+        finally:
+            pool.close()
+            pool.join()
+
+        return
+
+    next_link = first_page_request.links.get('next')
+
+    if next_link is None:
+        yield first_page_items, None
+        return
+
+    # Totals are omitted for large collections. Switch to keyset pagination where the endpoint supports it,
+    # continuing after the last item of the first page, and follow the offset links otherwise.
+    if keyset_order_by is not None:
+        keyset_url = set_query_params(url, {'pagination': 'keyset', 'order_by': keyset_order_by, 'sort': 'asc', 'id_after': first_page_items[-1]['id']}, ['page'])
+        keyset_request = session.get(keyset_url)
+
+        if keyset_request.ok:
+            keyset_next_link = keyset_request.links.get('next')
+            yield first_page_items, keyset_url
+            yield keyset_request.json(), keyset_next_link['url'] if keyset_next_link else None
+
+            if keyset_next_link:
+                for page_items, next_url in iterate_pagination_pages(session, keyset_next_link['url']):
+                    yield page_items, next_url
+
+            return
+
+    yield first_page_items, next_link['url']
+
+    for page_items, next_url in iterate_pagination_pages(session, next_link['url']):
+        yield page_items, next_url
 
 def get_group(session, server, group_name):
     group = session.get("{0}/api/v4/groups/{1}".format(server, urllib.quote(group_name, safe='')))
@@ -75,26 +160,54 @@ def get_group(session, server, group_name):
 
     return result
 
-def get_project(session, project_id):
-    if project_id not in project_cache:
+def get_group_project_index(session, server, group):
+    group_project_index = {}
+
+    # Only the path is needed to filter items, so request the reduced project representation
+    url = "{0}/api/v4/groups/{1}/projects?include_subgroups=true&simple=true&order_by=id&sort=asc&per_page={2}".format(server, group["id"], GITLAB_PER_PAGE)
+
+    for page_items, next_url in iterate_gitlab_pages(session, url, 'id'):
+        for project in page_items:
+            group_project_index[project["id"]] = project["path_with_namespace"]
+
+    return group_project_index
+
+def load_group_project_index(session, server, group, index_file, ttl_hours):
+    # Returns the index together with whether it was fetched by this run
+    index_state = load_state(index_file)
+
+    if index_state is not None and index_state["server"] == server and index_state["group_id"] == group["id"] and time.time() - index_state["fetched_at"] < ttl_hours * 60 * 60:
+        if is_debug:
+            print "DEBUG:: Loaded project index from {0}".format(index_file)
+
+        return dict([(int(project_id), path) for project_id, path in index_state["projects"].iteritems()]), False
+
+    group_project_index = get_group_project_index(session, server, group)
+
+    if index_file:
+        save_state(index_file, {"server": server, "group_id": group["id"], "fetched_at": time.time(), "projects": group_project_index})
+
+    return group_project_index, True
+
+def get_project_path(session, project_id):
+    # Projects missing from the index (e.g. created since it was built) are looked up individually
+    if project_id not in project_index:
         project_request = session.get("{0}/api/v4/projects/{1}".format(gitlab_server, project_id))
         project_request.raise_for_status()
-        project_cache[project_id]=project_request.json()
+        project_index[project_id]=project_request.json()["path_with_namespace"]
+        checkpoint.set('projects', str(project_id), project_index[project_id])
 
         if is_debug:
-            print "DEBUG:: Added project data to cache"
-            print "  {0}".format(json.dumps(project_cache[project_id], indent=4, sort_keys=True))
-    else:
-        project_cache.get(project_id)
+            print "DEBUG:: Added project {0} to index".format(project_index[project_id])
 
-    return project_cache[project_id]
+    return project_index[project_id]
 
 def is_data_item_allowed(item, group, session, repo_matcher):
     include_item = False
 
-    project = get_project(session, item["project_id"])
-    project_is_org_child = re.match("^{0}\/".format(group["path"]), project["path_with_namespace"]) != None
-    item_matches = re.match(repo_matcher, project["path_with_namespace"]) != None
+    project_path = get_project_path(session, item["project_id"])
+    project_is_org_child = re.match("^{0}\/".format(group["path"]), project_path) != None
+    item_matches = re.match(repo_matcher, project_path) != None
 
     if project_is_org_child and item_matches:
         if is_debug:
@@ -103,13 +216,27 @@ def is_data_item_allowed(item, group, session, repo_matcher):
 
     return include_item
 
-def get_group_project_data(data_type, session, server, group, start_date, repo_matcher):
-    allowed_data = []
+def get_matching_project_ids(group, repo_matcher):
+    # Projects selected by the repo matcher are queried individually, as long as there are few enough of them
+    if repo_matcher.pattern == DEFAULT_REPO_MATCHER:
+        return None
+
+    project_ids = sorted([project_id for project_id, project_path in project_index.iteritems()
+        if project_path.startswith("{0}/".format(group["path"])) and re.match(repo_matcher, project_path) != None])
 
-    base_url = "{0}/api/v4/groups/{1}/{2}".format(server, group["id"], data_type)
+    if len(project_ids) > MAX_PROJECT_ENDPOINTS:
+        return None
+
+    return project_ids
+
+def iterate_group_project_data(data_type, session, server, group, start_date, repo_matcher, project_ids=None):
+    if project_ids is None:
+        sources = [(data_type, "{0}/api/v4/groups/{1}/{2}".format(server, group["id"], data_type))]
+    else:
+        sources = [("{0}/{1}".format(data_type, project_id), "{0}/api/v4/projects/{1}/{2}".format(server, project_id, data_type)) for project_id in project_ids]
 
     if is_debug:
-        print "DEBUG:: Getting {0} group {1}".format(group["path"], data_type)
+        print "DEBUG:: Getting {0} group {1} from {2} endpoint(s)".format(group["path"], data_type, len(sources))
 
     query_state = "&state="
     if data_type == "issues":
@@ -119,87 +246,115 @@ def get_group_project_data(data_type, session, server, group, start_date, repo_m
     else:
         query_state = ""
 
+    # Items can only be merged or closed after their last update, so older items are not requested
     query_date = "&updated_after={0}".format(start_date.strftime("%Y-%m-%d"))
 
-    query_string = "?scope=all&per_page=1000{0}{1}".format(query_state, query_date)
+    # Only items authored by the user are counted when a username is given
+    query_author = ""
+    if username is not None:
+        query_author = "&author_username={0}".format(urllib.quote(username, safe=''))
 
-    if is_debug:
-        print "DEBUG:: Query URL: {0}".format(base_url+query_string)
+    query_string = "?scope=all&per_page={0}{1}{2}{3}".format(GITLAB_PER_PAGE, query_state, query_date, query_author)
 
-    query_result = handle_pagination_items(session, base_url+query_string)
+    for progress_key, base_url in sources:
+        if is_debug:
+            print "DEBUG:: Query URL: {0}".format(base_url+query_string)
 
-    for item in query_result:
-        if is_data_item_allowed(item, group, session, repo_matcher):
-            allowed_data.append(item)
+        # Continue from the last page recorded by an interrupted run
+        progress = checkpoint.get('pages', progress_key, {'next': base_url+query_string, 'items': []})
+        allowed_data = progress['items']
 
-    if is_debug:
-        print "DEBUG:: ALLOWED_DATA - {0}\n{1}".format(data_type, json.dumps(allowed_data, indent=4, sort_keys=True))
+        for item in allowed_data:
+            yield item
 
-    return allowed_data
+        if progress['next']:
+            for page_items, next_url in iterate_gitlab_pages(session, progress['next']):
+                page_allowed_data = [item for item in page_items if is_data_item_allowed(item, group, session, repo_matcher)]
+                # Stored by reference as the list only grows, copying it on every page would be quadratic.
+                # The items and the cursor are updated together, so a save never records a page without its cursor.
+                with checkpoint.lock:
+                    allowed_data.extend(page_allowed_data)
+                    checkpoint.set('pages', progress_key, {'next': next_url, 'items': allowed_data})
 
+                if is_debug:
+                    print "DEBUG:: ALLOWED_DATA - {0}\n{1}".format(progress_key, json.dumps(page_allowed_data, indent=4, sort_keys=True))
 
-parser = argparse.ArgumentParser(description='Gather GitLab Statistics.')
-parser.add_argument("-s", "--start-date", help="The start date to query from", type=valid_date)
-parser.add_argument("-u", "--username", help="Username to query")
-parser.add_argument("-l", "--labels", help="Comma separated list to display. Add '-' at end of each label to negate")
-parser.add_argument("-r", "--human-readable", action="store_true", help="Human readable display")
-parser.add_argument("-o", "--organization", help="Organization name", default=GITLAB_GROUP_DEFAULT)
-parser.add_argument("-m", "--repo-matcher", help="Repo Matcher", default=".+")
-args = parser.parse_args()
+                for item in page_allowed_data:
+                    yield item
 
-start_date = args.start_date
-username = args.username
-input_labels = args.labels
-human_readable=(args.human_readable==True)
-gitlab_group = args.organization
-repo_matcher = re.compile(args.repo_matcher)
+def get_merge_request_reviewers(session, mr):
+    # Approvers come first, followed by the other participants of the discussion
+    mr_url = "{0}/api/v4/projects/{1}/merge_requests/{2}".format(gitlab_server, mr["project_id"], mr["iid"])
 
-if start_date is None:
-    start_date = generate_start_date()
-start_date = pytz.utc.localize(start_date)
+    approvals_request = session.get("{0}/approvals".format(mr_url))
+    approvals_request.raise_for_status()
 
-gitlab_api_token = os.environ.get(GITLAB_API_TOKEN_NAME)
-gitlab_server = os.getenv(GITLAB_SERVER_NAME, GITLAB_SERVER_DEFAULT)
+    reviewers = [approval["user"]["username"] for approval in approvals_request.json().get("approved_by", [])]
 
-if not gitlab_api_token:
-    print "Error: GitLab API Token is Required!"
-    sys.exit(1)
+    for participant in iterate_pagination_items(session, "{0}/participants?per_page={1}".format(mr_url, GITLAB_PER_PAGE)):
+        if participant["username"] not in reviewers:
+            reviewers.append(participant["username"])
 
-session = requests.Session()
-session.headers = {
-    'Private-Token': gitlab_api_token
-}
+    return [reviewer for reviewer in reviewers if reviewer != mr["author"]["username"]]
 
+def add_merge_request_reviewers(session, mr):
+    # Reviewers are only looked up for MRs that can be counted, and reused until the MR is updated
+    if not mr['merged_at'] or dateutil.parser.parse(mr["merged_at"]) < start_date:
+        return mr
 
-group = get_group(session, gitlab_server, gitlab_group)
+    cached_reviewers = merge_request_reviewers.get(str(mr["id"]))
 
-if group is None:
-    print "Unable to Locate Group!"
-    sys.exit(1)
+    if cached_reviewers is None or cached_reviewers["updated_at"] != mr["updated_at"]:
+        if is_debug:
+            print "DEBUG:: Getting reviewers of MR {0}".format(mr["references"]["full"])
+
+        merge_request_reviewers[str(mr["id"])] = {"updated_at": mr["updated_at"], "reviewers": get_merge_request_reviewers(session, mr)}
+
+    return mr
 
+def collect_group_project_data(data_type, item_queue, session, server, group, start_date, repo_matcher, project_ids):
+    # Runs in its own thread, handing each item to the main thread as soon as its page arrives
+    pool = None
+
+    try:
+        items = iterate_group_project_data(data_type, session, server, group, start_date, repo_matcher, project_ids)
 
-group_merge_requests = get_group_project_data('merge_requests', session, gitlab_server, group, start_date, repo_matcher)
+        # Look up the reviewers of several MRs at once while keeping their order
+        if data_type == 'merge_requests' and reviewer_mode == REVIEWERS_APPROVALS:
+            pool = ThreadPool(workers)
+            items = pool.imap(lambda mr: add_merge_request_reviewers(session, mr), items)
 
-for mr in group_merge_requests:
+        for item in items:
+            item_queue.put((data_type, item, None))
+
+        item_queue.put((data_type, None, None))
+    except Exception:
+        item_queue.put((data_type, None, sys.exc_info()))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+def process_merge_request(mr):
     # Skip items that do not have a valid merged_at datetime
     if not mr['merged_at']:
-        continue
+        return
 
     if dateutil.parser.parse(mr["merged_at"]) < start_date:
         if is_debug:
             print "DEBUG:: Omit {0} MR {1} {2}/{3}".format(mr["state"], mr["merged_at"], mr['id'], mr['title'])
-        continue
+        return
     if is_debug:
         print "DEBUG:: Incl {0} MR {1} {2}/{3}".format(mr["state"], mr["merged_at"], mr['id'], mr['title'])
 
     # Filter out unwanted mr users (if username is specified, then we're only interested in MRs that have that user either the author or merger)
     if username is not None and (mr["author"]["username"] != username or mr["merged_by"]["username"] != username):
-        continue
+        return
 
     # Filter out if merged == author
     if mr["author"]["username"] == mr["merged_by"]["username"]:
         print "# Error: Author==Merged_by {0} {1} {2}".format(mr['id'], mr["author"]["username"], mr['title'])
-        continue
+        return
 
     # Merged MRs
     if mr["author"]["username"] not in merged_mrs:
@@ -209,26 +364,29 @@ for mr in group_merge_requests:
     author_mrs.append(mr)
     merged_mrs[mr["author"]["username"]] = author_mrs
 
-    # Reviewed MRs (assuming merged_by user is the reviewer, since GL doesn't have an "approve" feature in community edition)
-    if mr["merged_by"]["username"] not in reviewed_mrs:
-        reviewer_mrs = []
-    else:
-        reviewer_mrs = reviewed_mrs[mr["merged_by"]["username"]]
-    reviewer_mrs.append(mr)
-    reviewed_mrs[mr["merged_by"]["username"]] = reviewer_mrs
+    # Reviewed MRs (by default assuming merged_by user is the reviewer, since GL doesn't have an "approve" feature in community edition)
+    reviewers = [mr["merged_by"]["username"]]
 
+    if reviewer_mode == REVIEWERS_APPROVALS and merge_request_reviewers[str(mr["id"])]["reviewers"]:
+        reviewers = merge_request_reviewers[str(mr["id"])]["reviewers"]
 
-group_issues = get_group_project_data('issues', session, gitlab_server, group, start_date, repo_matcher)
+    for reviewer in reviewers:
+        if reviewer not in reviewed_mrs:
+            reviewer_mrs = []
+        else:
+            reviewer_mrs = reviewed_mrs[reviewer]
+        reviewer_mrs.append(mr)
+        reviewed_mrs[reviewer] = reviewer_mrs
 
-for iss in group_issues:
+def process_issue(iss):
     # Skip items that do not have a valid merged_at datetime
     if not iss['closed_at']:
-        continue
+        return
 
     if dateutil.parser.parse(iss["closed_at"]) < start_date:
         if is_debug:
             print "DEBUG:: Omit {0} Issue {1} {2}/{3} (shortId={4})".format(iss["state"], iss["closed_at"], iss['id'], iss['title'], iss['iid'])
-        continue
+        return
     if is_debug:
         print "DEBUG:: Incl {0} Issue {1} {2}/{3} (shortId={4})".format(iss["state"], iss["closed_at"], iss['id'], iss['title'], iss['iid'])
 
@@ -236,14 +394,14 @@ for iss in group_issues:
     if iss["author"]["username"] == iss["closed_by"]["username"]:
         # DISABLED SUPPORT INFORMATION UPDATES UNTIL FRONT END CAN USE THEM
         #        print "#Closed Issues/GL{0}/{1}/{2} [errorCode={6}, error={7}, org={3}, board={4}, linkId={5}]".format(iss['id'], iss["author"]["username"], 1, iss['web_url'].split('/')[3], iss['web_url'].split('/')[3], iss['iid'], "E1", "Author cannot close issues")
-        continue
+        return
 
     # Filter out non-closed issues (shouldn't be any but good to check)
 
     # Filter out unwanted users
     if username is not None and (iss["author"]["username"] != username or iss["closed_by"]["username"] != username):
         print "# Info: Filtered out : Issue was opened by {0}, and closed by {1}. User {2} was specified as filter".format(iss["author"]["username"], iss["closed_by"]["username"], username)
-        continue
+        return
 
     # Closed Issues
     if iss["closed_by"]["username"] not in closed_issues:
@@ -254,6 +412,139 @@ for iss in group_issues:
     closed_issues[iss["closed_by"]["username"]] = closed_by_iss
 
 
+parser = argparse.ArgumentParser(description='Gather GitLab Statistics.')
+parser.add_argument("-s", "--start-date", help="The start date to query from", type=valid_date)
+parser.add_argument("-u", "--username", help="Username to query")
+parser.add_argument("-l", "--labels", help="Comma separated list to display. Add '-' at end of each label to negate")
+parser.add_argument("-r", "--human-readable", action="store_true", help="Human readable display")
+parser.add_argument("-o", "--organization", help="Organization name", default=GITLAB_GROUP_DEFAULT)
+parser.add_argument("-m", "--repo-matcher", help="Repo Matcher", default=DEFAULT_REPO_MATCHER)
+parser.add_argument("-w", "--workers", help="Maximum number of concurrent page requests", type=int, default=DEFAULT_WORKERS)
+parser.add_argument("--reviewers", help="Credit reviews to the user merging the MR, or to its approvers and discussion participants", choices=[REVIEWERS_MERGED_BY, REVIEWERS_APPROVALS], default=REVIEWERS_MERGED_BY)
+parser.add_argument("--reviewer-cache-file", help="JSON file used to keep MR reviewers between runs")
+parser.add_argument("--project-index-file", help="JSON file used to keep the group project index between runs")
+parser.add_argument("--project-index-ttl", help="Hours before the stored project index is rebuilt", type=int, default=DEFAULT_PROJECT_INDEX_TTL_HOURS)
+parser.add_argument("--checkpoint-file", help="JSON file used to periodically save the progress of the run")
+parser.add_argument("--resume", action="store_true", help="Resume from the progress saved in the checkpoint file")
+parser.add_argument("--identity-directory", help="SQLite file in which the usernames of the contributors are recorded")
+parser.add_argument("--http-cache", help="SQLite file used to cache responses between runs")
+parser.add_argument("--http-cache-ttl", help="Days before an unvalidated cached response expires", type=int, default=DEFAULT_HTTP_CACHE_TTL_DAYS)
+args = parser.parse_args()
+
+if args.resume and not args.checkpoint_file:
+    parser.error("--resume requires --checkpoint-file")
+
+start_date = args.start_date
+username = args.username
+input_labels = args.labels
+human_readable=(args.human_readable==True)
+gitlab_group = args.organization
+repo_matcher = re.compile(args.repo_matcher)
+workers = max(1, args.workers)
+reviewer_mode = args.reviewers
+
+if start_date is None:
+    start_date = generate_start_date()
+start_date = pytz.utc.localize(start_date)
+
+gitlab_api_token = os.environ.get(GITLAB_API_TOKEN_NAME)
+gitlab_server = os.getenv(GITLAB_SERVER_NAME, GITLAB_SERVER_DEFAULT)
+
+if not gitlab_api_token:
+    print "Error: GitLab API Token is Required!"
+    sys.exit(1)
+
+session = requests.Session()
+session.headers = {
+    'Private-Token': gitlab_api_token
+}
+
+# Size the connection pool to match the concurrent workers of every collection
+pool_size = workers * len(GROUP_DATA_TYPES)
+
+if args.http_cache:
+    install_http_cache(session, args.http_cache, args.http_cache_ttl, pool_connections=pool_size, pool_maxsize=pool_size)
+else:
+    session.mount('https://', requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size))
+
+
+group = get_group(session, gitlab_server, gitlab_group)
+
+if group is None:
+    print "Unable to Locate Group!"
+    sys.exit(1)
+
+
+checkpoint_signature = {
+    'server': gitlab_server,
+    'group': gitlab_group,
+    'start_date': start_date.isoformat(),
+    'repo_matcher': args.repo_matcher,
+    'username': username
+}
+
+checkpoint = Checkpoint(args.checkpoint_file, checkpoint_signature, args.resume)
+
+if checkpoint.resumed:
+    print "# Info: Resuming from checkpoint '{0}'".format(args.checkpoint_file)
+
+    for project_id, project_path in checkpoint.get_section('projects').iteritems():
+        project_index[int(project_id)] = project_path
+
+# Resolve the projects of all items with one paginated listing instead of one request per project
+group_project_index, project_index_fetched = load_group_project_index(session, gitlab_server, group, args.project_index_file, args.project_index_ttl)
+project_index.update(group_project_index)
+
+# A stored index misses the projects added to the group since it was saved, so only a fetched one can select the projects to query
+project_ids = get_matching_project_ids(group, repo_matcher) if project_index_fetched else None
+
+if reviewer_mode == REVIEWERS_APPROVALS:
+    merge_request_reviewers.update(load_state(args.reviewer_cache_file) or {})
+
+# Merge requests and issues are collected concurrently and aggregated as they arrive
+item_processors = {
+    'merge_requests': process_merge_request,
+    'issues': process_issue
+}
+
+item_queue = Queue.Queue(ITEM_QUEUE_SIZE)
+
+for data_type in GROUP_DATA_TYPES:
+    collector = threading.Thread(target=collect_group_project_data, args=(data_type, item_queue, session, gitlab_server, group, start_date, repo_matcher, project_ids))
+    collector.daemon = True
+    collector.start()
+
+running_collectors = len(GROUP_DATA_TYPES)
+
+while running_collectors > 0:
+    # Wait with a timeout so that the main thread stays responsive to interrupts
+    try:
+        data_type, item, error = item_queue.get(True, 1)
+    except Queue.Empty:
+        continue
+
+    if error is not None:
+        raise error[0], error[1], error[2]
+
+    if item is None:
+        running_collectors -= 1
+        continue
+
+    item_processors[data_type](item)
+
+
+# Record the contributors so their points can be joined with the other collectors
+if args.identity_directory:
+    identity_directory = IdentityDirectory(args.identity_directory)
+
+    for contributor in sorted(set(merged_mrs.keys() + reviewed_mrs.keys() + closed_issues.keys())):
+        identity_directory.record(GITLAB_SOURCE, contributor, contributor)
+
+if reviewer_mode == REVIEWERS_APPROVALS and args.reviewer_cache_file:
+    save_state(args.reviewer_cache_file, merge_request_reviewers)
+
+checkpoint.complete()
+
 print "=== Statistics for GitLab Group '{0}' ====".format(gitlab_group)
 
 print "\n== Merged MR's ==\n"
@@ -273,11 +564,11 @@ for key, value in merged_mrs.iteritems():
 print "\n== Reviewed MR's ==\n"
 for key, value in reviewed_mrs.iteritems():
     if human_readable:
-        print "{0} - {1}".format(value[0]['merged_by']['username'], len(value))
+        print "{0} - {1}".format(key, len(value))
     for mr_value in value:
         if not human_readable:
-            # 1 point to reviewer (assuming merged_by is reviewer) for merged MR's
-            print "Reviewed Merge Requests/GL{0}/{1}/{2} [org={3}, board={4}, linkId={5}]".format(mr_value['id'], mr_value['merged_by']['username'], 1, mr_value['web_url'].split('/')[3], '/'.join(mr_value['web_url'].split('/')[4:(len(mr_value['web_url'].split('/'))-3)]), mr_value['web_url'].split('/')[-1])
+            # 1 point to reviewer for merged MR's
+            print "Reviewed Merge Requests/GL{0}/{1}/{2} [org={3}, board={4}, linkId={5}]".format(mr_value['id'], key, 1, mr_value['web_url'].split('/')[3], '/'.join(mr_value['web_url'].split('/')[4:(len(mr_value['web_url'].split('/'))-3)]), mr_value['web_url'].split('/')[-1])
             if is_debug:
                 print "  {0}".format(json.dumps(mr_value, indent=4, sort_keys=True))
         else:
@@ -3,6 +3,7 @@
 from oauth2client.service_account import ServiceAccountCredentials
 from os import path
 import os, requests, sys, argparse
+from pagination import iterate_token_pagination_items
 
 SERVICE_ACCOUNT_KEY_FILE_NAME='SERVICE_ACCOUNT_KEY_FILE'
 HANGOUTS_CHATS_API='https://chat.googleapis.com/v1'
@@ -23,10 +24,10 @@ def login(session, service_account_key_file):
     session.headers.update(auth_headers)
 
 def get_spaces(session):
-    return handle_pagination_items(session, "{0}/spaces".format(HANGOUTS_CHATS_API), SPACES_KEY)
+    return iterate_token_pagination_items(session, "{0}/spaces".format(HANGOUTS_CHATS_API), SPACES_KEY)
 
 def get_members_in_space(session, space):
-    members = handle_pagination_items(session, "{0}/{1}/members".format(HANGOUTS_CHATS_API, space["name"]), MEMBERS_KEY)
+    members = iterate_token_pagination_items(session, "{0}/{1}/members".format(HANGOUTS_CHATS_API, space["name"]), MEMBERS_KEY)
 
     human_members = []
 
@@ -56,21 +57,6 @@ def get_spaces_with_members(session):
     
     return spaces_with_members
 
-def handle_pagination_items(session, url, key, next_page_token=None):
-    params = {}
-
-    if next_page_token is not None and next_page_token != "":
-        params["pageToken"] = next_page_token
- 
-    response = session.get(url, params=params)
-
-    response_json = response.json()
-
-    if "nextPageToken" in response_json and response_json["nextPageToken"] != "":
-        return response_json[key] + handle_pagination_items(session, url, key, response_json["nextPageToken"])
-    else:
-        return response_json[key]
-
 def encode_text(text):
     if text:
         return text.encode("utf-8")
@@ -0,0 +1,154 @@
+# Persistent HTTP response cache shared by the statistics scripts.
+#
+# Responses carrying an ETag or Last-Modified header are stored in a SQLite
+# database. Later requests for the same URL (and credentials) are sent as
+# conditional requests, and a 304 Not Modified answer is completed from the
+# stored body. Entries that have not been revalidated within the TTL expire
+# and the least recently used entries
+# are evicted once the cache grows beyond its maximum size.
+
+import atexit, hashlib, json, sqlite3, threading, time
+import requests
+from requests.structures import CaseInsensitiveDict
+
+DEFAULT_HTTP_CACHE_TTL_DAYS = 30
+DEFAULT_HTTP_CACHE_MAX_ENTRIES = 100000
+HTTP_CACHE_COMMIT_INTERVAL = 100
+
+# Headers identifying the caller, so responses are never shared between credentials
+AUTH_HEADERS = ['Authorization', 'Private-Token', 'X-Auth-Token', 'X-User-Id']
+
+# Headers describing the transfer of the original body rather than the body itself
+TRANSFER_HEADERS = ['Content-Encoding', 'Content-Length', 'Transfer-Encoding']
+
+
+class CachingHTTPAdapter(requests.adapters.HTTPAdapter):
+
+    def __init__(self, cache_file, ttl_days=DEFAULT_HTTP_CACHE_TTL_DAYS, max_entries=DEFAULT_HTTP_CACHE_MAX_ENTRIES, auth_headers=AUTH_HEADERS, **kwargs):
+        super(CachingHTTPAdapter, self).__init__(**kwargs)
+        self.auth_headers = auth_headers
+        self.ttl = ttl_days * 24 * 60 * 60
+        self.max_entries = max_entries
+        self.cache_lock = threading.Lock()
+        self.pending_writes = 0
+        self.requests = 0
+        self.hits = 0
+
+        self.cache = sqlite3.connect(cache_file, check_same_thread=False)
+        self.cache.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, headers TEXT, content BLOB, stored_at REAL, accessed_at REAL)")
+        self.cache.execute("CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)")
+        self.cache.execute("DELETE FROM responses WHERE stored_at < ?", (time.time() - self.ttl,))
+        self.cache.commit()
+
+        atexit.register(self.close)
+
+    def cache_key(self, request):
+        identity = [request.headers.get(header, '') for header in self.auth_headers]
+
+        key_material = "\n".join([request.method, request.url] + identity)
+
+        if isinstance(key_material, unicode):
+            key_material = key_material.encode('utf-8')
+
+        # Only a digest is stored as URLs may carry credentials (e.g. Trello key and token)
+        return hashlib.sha256(key_material).hexdigest()
+
+    def get_cached_response(self, key):
+        with self.cache_lock:
+            return self.cache.execute("SELECT etag, last_modified, headers, content FROM responses WHERE key = ?", (key,)).fetchone()
+
+    def store_response(self, key, response):
+        headers = dict([(name, value) for name, value in response.headers.items() if name not in TRANSFER_HEADERS])
+        now = time.time()
+
+        with self.cache_lock:
+            self.cache.execute("INSERT OR REPLACE INTO responses (key, etag, last_modified, headers, content, stored_at, accessed_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, response.headers.get('ETag'), response.headers.get('Last-Modified'), json.dumps(headers), sqlite3.Binary(response.content), now, now))
+            self.record_write()
+
+    def refresh_response(self, key):
+        now = time.time()
+
+        with self.cache_lock:
+            self.cache.execute("UPDATE responses SET stored_at = ?, accessed_at = ? WHERE key = ?", (now, now, key))
+            self.record_write()
+
+    def record_write(self):
+        self.pending_writes += 1
+
+        if self.pending_writes >= HTTP_CACHE_COMMIT_INTERVAL:
+            self.evict()
+            self.cache.commit()
+            self.pending_writes = 0
+
+    def evict(self):
+        entries = self.cache.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+        if entries > self.max_entries:
+            self.cache.execute("DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY accessed_at LIMIT ?)", (entries - self.max_entries,))
+
+    def send(self, request, **kwargs):
+        if request.method != 'GET':
+            return super(CachingHTTPAdapter, self).send(request, **kwargs)
+
+        key = self.cache_key(request)
+        cached_response = self.get_cached_response(key)
+
+        if cached_response is not None:
+            etag, last_modified, headers, content = cached_response
+
+            if etag:
+                request.headers['If-None-Match'] = etag
+            if last_modified:
+                request.headers['If-Modified-Since'] = last_modified
+
+        response = super(CachingHTTPAdapter, self).send(request, **kwargs)
+        response.from_cache = False
+
+        with self.cache_lock:
+            self.requests += 1
+
+        if response.status_code == 304 and cached_response is not None:
+            # Read the empty body first, so the connection is released to the pool before the stored body is installed
+            response.content
+
+            # Keep the fresh headers (rate limits, pagination) on top of the stored ones
+            cached_headers = CaseInsensitiveDict(json.loads(headers))
+            cached_headers.update(response.headers)
+
+            for header in TRANSFER_HEADERS:
+                cached_headers.pop(header, None)
+
+            response.status_code = 200
+            response.headers = cached_headers
+            response._content = str(content)
+            response.from_cache = True
+
+            self.refresh_response(key)
+
+            with self.cache_lock:
+                self.hits += 1
+
+        elif response.status_code == 200 and ('ETag' in response.headers or 'Last-Modified' in response.headers):
+            self.store_response(key, response)
+
+        return response
+
+    def close(self):
+        with self.cache_lock:
+            self.evict()
+            self.cache.commit()
+
+        super(CachingHTTPAdapter, self).close()
+
+    def cache_usage(self):
+        return "{0} of {1} responses served from cache".format(self.hits, self.requests)
+
+
+def install_http_cache(session, cache_file, ttl_days=DEFAULT_HTTP_CACHE_TTL_DAYS, **kwargs):
+    adapter = CachingHTTPAdapter(cache_file, ttl_days, **kwargs)
+
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+
+    return adapter
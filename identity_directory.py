@@ -0,0 +1,88 @@
+# Directory of the people behind the accounts seen by the statistics scripts.
+#
+# Each account (a Trello member id, a GitHub or GitLab login, a RocketChat
+# username or an email address) is stored in a SQLite database together with
+# the key of the person it belongs to. Accounts are linked to a person by
+# their username unless another person key is set in the database, and email
+# addresses of the organization domain by their local part. Entries that have
+# not been refreshed within the TTL are looked up again by the scripts.
+
+import atexit, json, sqlite3, threading, time
+
+DEFAULT_IDENTITY_TTL_DAYS = 7
+IDENTITY_COMMIT_INTERVAL = 100
+ORGANIZATION_EMAIL_DOMAIN = 'redhat.com'
+
+TRELLO_SOURCE = 'trello'
+GITHUB_SOURCE = 'github'
+GITLAB_SOURCE = 'gitlab'
+ROCKETCHAT_SOURCE = 'rocketchat'
+EMAIL_SOURCE = 'email'
+
+
+class IdentityDirectory(object):
+    """Accounts of each source mapped to a person key
+
+    Without a directory file the identities are only kept in memory.
+    """
+
+    def __init__(self, directory_file=None, ttl_days=DEFAULT_IDENTITY_TTL_DAYS):
+        self.ttl = ttl_days * 24 * 60 * 60
+        self.lock = threading.Lock()
+        self.pending_writes = 0
+
+        self.directory = sqlite3.connect(directory_file or ':memory:', check_same_thread=False)
+        self.directory.execute("CREATE TABLE IF NOT EXISTS identities (source TEXT, identifier TEXT, person TEXT, username TEXT, profile TEXT, updated_at REAL, PRIMARY KEY (source, identifier))")
+        self.directory.execute("CREATE INDEX IF NOT EXISTS identities_person ON identities (person)")
+        self.directory.commit()
+
+        atexit.register(self.close)
+
+    def lookup(self, source, identifier):
+        # Returns the stored profile, or None when the account is unknown or its entry expired
+        with self.lock:
+            identity = self.directory.execute("SELECT profile, updated_at FROM identities WHERE source = ? AND identifier = ?", (source, identifier)).fetchone()
+
+        if identity is None or time.time() - identity[1] >= self.ttl:
+            return None
+
+        return json.loads(identity[0])
+
+    def record(self, source, identifier, username, profile=None):
+        # The person key of a known account is kept, so links made in the directory survive refreshes
+        with self.lock:
+            identity = self.directory.execute("SELECT person FROM identities WHERE source = ? AND identifier = ?", (source, identifier)).fetchone()
+            person = identity[0] if identity is not None else username.lower()
+
+            self.directory.execute("INSERT OR REPLACE INTO identities (source, identifier, person, username, profile, updated_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (source, identifier, person, username, json.dumps(profile if profile is not None else {"username": username}), time.time()))
+            self.record_write()
+
+    def record_email(self, email):
+        # Returns the username of an organization address, which is also its person key
+        username = email.replace("@{0}".format(ORGANIZATION_EMAIL_DOMAIN), "")
+        self.record(EMAIL_SOURCE, email.lower(), username)
+
+        return username
+
+    def person(self, source, identifier):
+        with self.lock:
+            identity = self.directory.execute("SELECT person FROM identities WHERE source = ? AND identifier = ?", (source, identifier)).fetchone()
+
+        return identity[0] if identity is not None else None
+
+    def accounts(self, person):
+        # All accounts linked to a person, e.g. to join the points of every collector
+        with self.lock:
+            return self.directory.execute("SELECT source, identifier, username FROM identities WHERE person = ? ORDER BY source, identifier", (person,)).fetchall()
+
+    def record_write(self):
+        self.pending_writes += 1
+
+        if self.pending_writes >= IDENTITY_COMMIT_INTERVAL:
+            self.directory.commit()
+            self.pending_writes = 0
+
+    def close(self):
+        with self.lock:
+            self.directory.commit()
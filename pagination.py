@@ -0,0 +1,48 @@
+# Pagination helpers shared by the statistics scripts.
+#
+# Each helper is a generator: a page is only requested once the items of the
+# previous page have been consumed, so callers can filter and aggregate while
+# pages are still arriving and the stack depth stays constant.
+
+
+def iterate_pagination_pages(session, url, items_key=None):
+    # Follow the 'next' relation of the Link header until it is no longer present.
+    # The URL of the next page is yielded along with the items so callers can
+    # record it as a cursor and resume from it later.
+    while url:
+        pagination_request = session.get(url)
+        pagination_request.raise_for_status()
+
+        pagination_json = pagination_request.json()
+
+        next_link = pagination_request.links.get('next')
+        url = next_link['url'] if next_link else None
+
+        yield pagination_json[items_key] if items_key is not None else pagination_json, url
+
+
+def iterate_pagination_items(session, url, items_key=None):
+    for page_items, next_url in iterate_pagination_pages(session, url, items_key):
+        for item in page_items:
+            yield item
+
+
+def iterate_token_pagination_items(session, url, items_key, token_key='nextPageToken', token_param='pageToken'):
+    # APIs such as Google Chat return a continuation token in the body instead of a Link header
+    params = {}
+
+    while True:
+        pagination_request = session.get(url, params=params)
+        pagination_request.raise_for_status()
+
+        pagination_json = pagination_request.json()
+
+        for item in pagination_json.get(items_key, []):
+            yield item
+
+        next_page_token = pagination_json.get(token_key)
+
+        if not next_page_token:
+            return
+
+        params = {token_param: next_page_token}
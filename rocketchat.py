@@ -3,6 +3,11 @@
 import os, json, requests, sys, argparse, collections, re, operator, csv
 from datetime import datetime, timedelta
 from dateutil.relativedelta import relativedelta
+from itertools import izip
+from multiprocessing.pool import ThreadPool
+from http_cache import install_http_cache, DEFAULT_HTTP_CACHE_TTL_DAYS
+from state_store import load_state, save_state
+from identity_directory import IdentityDirectory, ROCKETCHAT_SOURCE
 
 ROCKETCHAT_SERVER_DEFAULT = 'chat.consulting.redhat.com'
 ROCKETCHAT_USERNAME = 'ROCKETCHAT_USERNAME'
@@ -10,8 +15,18 @@ ROCKETCHAT_PASSWORD = 'ROCKETCHAT_PASSWORD'
 ROCKETCHAT_AUTH_TOKEN = 'ROCKETCHAT_AUTH_TOKEN'
 ROCKETCHAT_USER_ID = 'ROCKETCHAT_USER_ID'
 ROCKETCHAT_MESSAGE_SEARCH_DEFAULT=7
-ROCKETCHAT_MESSAGE_COUNT=50
+ROCKETCHAT_MESSAGE_COUNT=1000
+ROCKETCHAT_CHANNEL_COUNT=100
+HISTORY_TYPES=['messages', 'joined', 'removed']
+CSV_OUTPUT_FORMAT='csv'
+JSON_LINES_OUTPUT_FORMAT='jsonl'
+TEXT_OUTPUT_FORMAT='text'
+OUTPUT_FILE_FIELDNAMES=['Chat Channel (ID)', 'Time Period', '# Users Joined', '# Messages', 'Individual User Data - % messages/channel/user']
+OUTPUT_FILE_BUFFER_SIZE=64 * 1024
+# Only the fields used to tally the messages are requested
+ROCKETCHAT_MESSAGE_FIELDS={'t': 1, 'msg': 1, 'u.username': 1, 'ts': 1}
 ROCKETCHAT_TIME_FORMAT='%Y-%m-%dT%H:%M:%S.000Z'
+DEFAULT_WORKERS=8
 
 def login(session, server, username, password, authToken, userId):
     if not authToken or not userId:
@@ -44,37 +59,50 @@ def login(session, server, username, password, authToken, userId):
 
     return None
 
-def get_channels(session, server):
+def get_channels(session, server, channel_filter):
+    # Only channels whose description contains the filter are listed, with just the fields that are used
+    query_params = {
+        'query': json.dumps({'description': {'$regex': re.escape(channel_filter)}}),
+        'fields': json.dumps({'name': 1, 'description': 1})
+    }
+
+    try:
+        return list_channels(session, server, query_params)
+    except requests.exceptions.HTTPError as e:
+        if e.response.status_code != 400:
+            raise
+
+        # Servers rejecting the query parameters list every channel, which filter_channels narrows down
+        return list_channels(session, server, {})
+
+def list_channels(session, server, query_params):
     channels = []
-    count = 50
-    passes = 0
+    params = dict(query_params, count=ROCKETCHAT_CHANNEL_COUNT)
     fetched = 0
-    total = 0
+    total = 1
 
-    while fetched <= total:
-        params = {'count': count, 'offset': fetched}
+    while fetched < total:
+        params['offset'] = fetched
 
         channel_list = session.get("https://{0}/api/v1/channels.list".format(server), params=params)
+        channel_list.raise_for_status()
 
         channel_list_json = channel_list.json()
 
         total = channel_list_json['total']
 
+        if len(channel_list_json['channels']) == 0:
+            break
+
         channels.extend(channel_list_json['channels'])
 
-        passes += 1
-        fetched = count * passes
+        fetched += len(channel_list_json['channels'])
 
     return channels
 
 def filter_channels(channels, channel_filter):
-
-    for channel in reversed(channels):
-        if 'description' in channel:
-            if channel_filter not in channel['description']:
-                channels.remove(channel)
-        else:
-            channels.remove(channel)
+    # Servers ignoring or rejecting the query parameter return every channel, so the filter is applied again
+    return [channel for channel in channels if 'description' in channel and channel_filter in channel['description']]
 
 def process_item(final_dict, history_type, key):
     if key in final_dict[history_type]:
@@ -91,52 +119,137 @@ def plural_items(text, obj):
         return text
 
 
+def new_history_stats():
+    return {'messages': {}, 'joined': {}, 'removed': {}, 'statistics': {'messages': 0, 'joined': 0, 'removed': 0}}
+
+def tally_message(final_dict, message):
+    if 't' in message:
+        if message['t'] == "uj":
+            process_item(final_dict, "joined",message['msg'])
+        elif message['t'] == "ru":
+            process_item(final_dict, "removed",message['msg'])
+    else:
+        process_item(final_dict, "messages",message['u']['username'])
+
 def get_channel_history_stats(session, channel, newest_date, oldest_date):
     formatted_oldest_date = oldest_date.strftime(ROCKETCHAT_TIME_FORMAT)
     formatted_newest_date = newest_date.strftime(ROCKETCHAT_TIME_FORMAT)
-    return get_channel_history(session, channel, formatted_oldest_date, formatted_newest_date)
 
-def get_channel_history(session, channel, oldest_date, newest_date, current_latest_date=None, final_dict=None):
+    final_dict = new_history_stats()
 
-    if final_dict is None:
-        final_dict = {'messages': {}, 'joined': {}, 'removed': {}, 'statistics': {'messages': 0, 'joined': 0, 'removed': 0}}
+    for message in iterate_channel_history(session, channel, formatted_oldest_date, formatted_newest_date):
+        tally_message(final_dict, message)
 
-    params = {'roomId': channel['_id'], 'oldest': oldest_date, 'count': ROCKETCHAT_MESSAGE_COUNT}
+    return final_dict
 
-    if current_latest_date is not None:
-        params['latest'] = current_latest_date
+def get_stored_channel_history_stats(session, channel, newest_date, oldest_date, channel_state):
+    # Only messages newer than the watermark are fetched, the window is then answered from the daily tallies
+    formatted_oldest_date = oldest_date.strftime(ROCKETCHAT_TIME_FORMAT)
+    formatted_newest_date = newest_date.strftime(ROCKETCHAT_TIME_FORMAT)
 
-    channel_history = session.get("https://{0}/api/v1/channels.history?".format(server), params=params)
+    # Tallies not reaching back to the start of the window are rebuilt
+    if 'since' not in channel_state or channel_state['since'] > formatted_oldest_date:
+        channel_state.update({'since': formatted_oldest_date, 'watermark': formatted_oldest_date, 'days': {}})
 
-    messages = channel_history.json()['messages']
+    for message in iterate_channel_history(session, channel, channel_state['watermark'], formatted_newest_date):
+        day_stats = channel_state['days'].setdefault(message['ts'][:10], new_history_stats())
+        tally_message(day_stats, message)
 
-    for message in messages:
+        channel_state['watermark'] = max(channel_state['watermark'], message['ts'])
 
-        if 't' in message:
-            if message['t'] == "uj":
-                process_item(final_dict, "joined",message['msg'])
-            elif message['t'] == "ru":
-                process_item(final_dict, "removed",message['msg'])
-        else:
-            process_item(final_dict, "messages",message['u']['username'])
+    final_dict = new_history_stats()
+    oldest_day = oldest_date.strftime("%Y-%m-%d")
 
-    if len(messages) > 0:
-        return get_channel_history(session, channel, oldest_date, newest_date, messages[-1]['ts'], final_dict)
-    else:
-        return final_dict
+    for day, day_stats in channel_state['days'].iteritems():
+        if day < oldest_day:
+            continue
+
+        for history_type in HISTORY_TYPES:
+            for key, count in day_stats[history_type].iteritems():
+                final_dict[history_type][key] = final_dict[history_type].get(key, 0) + count
+
+            final_dict['statistics'][history_type] += day_stats['statistics'][history_type]
+
+    return final_dict
+
+def iterate_channel_history(session, channel, oldest_date, newest_date):
+    # The window is fixed by both dates, so paging by offset neither skips nor repeats messages sharing a timestamp.
+    # Servers may return fewer messages than requested (API_Upper_Count_Limit), so only an empty page ends the history.
+    params = {'roomId': channel['_id'], 'oldest': oldest_date, 'latest': newest_date, 'count': message_count, 'fields': json.dumps(ROCKETCHAT_MESSAGE_FIELDS)}
+    offset = 0
+
+    while True:
+        params['offset'] = offset
+
+        channel_history = session.get("https://{0}/api/v1/channels.history".format(server), params=params)
+        channel_history.raise_for_status()
+
+        messages = channel_history.json()['messages']
+
+        if len(messages) == 0:
+            return
+
+        for message in messages:
+            yield message
+
+        offset += len(messages)
+
+def build_channel_report(channel, channel_history_stats, time_period):
+    total_messages = channel_history_stats['statistics']['messages']
+
+    users = []
+    for username, username_num_messages in sorted(channel_history_stats['messages'].iteritems(), key=lambda (k,v): (v,k), reverse=True):
+        users.append({'username': username, 'messages': username_num_messages, 'percentage': float(username_num_messages)/float(total_messages)*100})
+
+    return {
+        'channel': "#{0}".format(channel['name']),
+        'time_period': time_period,
+        'joined': channel_history_stats['statistics']['joined'],
+        'removed': channel_history_stats['statistics']['removed'],
+        'messages': total_messages,
+        'users': users
+    }
+
+def format_user_messages(user):
+    return "{0} - {1:.2f}% - {2} {3}".format(user['username'], user['percentage'], user['messages'], plural_items("Messages", user['messages']))
+
+def format_channel_report(channel_report):
+    lines = [
+        channel_report['channel'],
+        "  {0} {1} Joined".format(channel_report['joined'], plural_items("Users", channel_report['joined'])),
+        "  {0} {1} Removed".format(channel_report['removed'], plural_items("Users", channel_report['removed'])),
+        "  {0} {1}".format(channel_report['messages'], plural_items("Messages", channel_report['messages']))
+    ]
+
+    for user in channel_report['users']:
+        lines.append("    * {0}".format(format_user_messages(user)))
 
-def write_ouput_file_record(filename, output_file_records, first_record=None):
+    return lines
 
-    mode = 'a' if not first_record else 'w'
 
-    with open(filename, mode) as f:
-        fieldnames = ['Chat Channel (ID)', 'Time Period', '# Users Joined', '# Messages', 'Individual User Data - % messages/channel/user']
-        writer = csv.writer(f)
+class ChannelReportWriter(object):
+    """Writes the channel reports to an output file opened once for the whole run"""
 
-        if first_record is not None and first_record == True:
-             writer.writerow(fieldnames)
+    def __init__(self, filename, output_format, report_header):
+        self.output_format = output_format
+        self.output_file = open(filename, 'w', OUTPUT_FILE_BUFFER_SIZE)
+
+        if output_format == CSV_OUTPUT_FORMAT:
+            self.csv_writer = csv.writer(self.output_file)
+            self.csv_writer.writerow(OUTPUT_FILE_FIELDNAMES)
+        elif output_format == TEXT_OUTPUT_FORMAT:
+            self.output_file.write("{0}\n".format(report_header))
+
+    def write(self, channel_report):
+        if self.output_format == CSV_OUTPUT_FORMAT:
+            self.csv_writer.writerow([channel_report['channel'], channel_report['time_period'], channel_report['joined'], channel_report['messages'], "\n".join([format_user_messages(user) for user in channel_report['users']])])
+        elif self.output_format == JSON_LINES_OUTPUT_FORMAT:
+            self.output_file.write("{0}\n".format(json.dumps(channel_report, sort_keys=True)))
+        else:
+            self.output_file.write("{0}\n".format("\n".join(format_channel_report(channel_report))))
 
-        writer.writerow(output_file_records)
+    def close(self):
+        self.output_file.close()
 
 
 rocketchat_username = os.environ.get(ROCKETCHAT_USERNAME)
@@ -149,12 +262,21 @@ parser.add_argument("-f","--filter", help="Text in Channel Description to Filter
 parser.add_argument("-d","--days", help="Number of Days to Search for Records", type=int)
 parser.add_argument("-s","--server", help="Rocketchat Server")
 parser.add_argument("-o","--output", help="Output File")
+parser.add_argument("--output-format", help="Format of the output file", choices=[CSV_OUTPUT_FORMAT, JSON_LINES_OUTPUT_FORMAT, TEXT_OUTPUT_FORMAT], default=CSV_OUTPUT_FORMAT)
+parser.add_argument("-p","--page-size", help="Number of messages requested per channel history page", type=int, default=ROCKETCHAT_MESSAGE_COUNT)
+parser.add_argument("-w","--workers", help="Maximum number of channel histories fetched concurrently", type=int, default=DEFAULT_WORKERS)
+parser.add_argument("--state-file", help="JSON file keeping daily tallies of every channel, so later runs only fetch newer messages")
+parser.add_argument("--identity-directory", help="SQLite file in which the usernames of the channel members are recorded")
+parser.add_argument("--http-cache", help="SQLite file used to cache responses between runs")
+parser.add_argument("--http-cache-ttl", help="Days before an unvalidated cached response expires", type=int, default=DEFAULT_HTTP_CACHE_TTL_DAYS)
 args = parser.parse_args()
 
 filtered_text = args.filter
 server = args.server
 days = args.days
 output_file = args.output
+workers = max(1, args.workers)
+message_count = max(1, args.page_size)
 
 if not server:
     server = ROCKETCHAT_SERVER_DEFAULT
@@ -162,66 +284,85 @@ if not server:
 if not days:
     days = ROCKETCHAT_MESSAGE_SEARCH_DEFAULT
 
+identity_directory = IdentityDirectory(args.identity_directory) if args.identity_directory else None
+
 session = requests.Session()
 
+# Size the connection pool to match the number of concurrent workers
+if args.http_cache:
+    # Login tokens change on every username/password login, so entries are only keyed on the stable user id
+    install_http_cache(session, args.http_cache, args.http_cache_ttl, auth_headers=['X-User-Id'], pool_connections=workers, pool_maxsize=workers)
+else:
+    session.mount('https://', requests.adapters.HTTPAdapter(pool_connections=workers, pool_maxsize=workers))
+
 error = login(session, server, rocketchat_username, rocketchat_password, rocketchat_auth_token, rocketchat_user_id)
 
 if error is not None:
     print error
     sys.exit(1)
 
-channels = get_channels(session, server)
+channels = get_channels(session, server, filtered_text)
 
-filter_channels(channels, filtered_text)
+channels = filter_channels(channels, filtered_text)
 
 newest_date = datetime.now().utcnow()
 oldest_date = newest_date - relativedelta(days=days)
 
+channel_store = None
+
+if args.state_file:
+    channel_store = load_state(args.state_file)
+
+    if channel_store is None or channel_store['server'] != server:
+        channel_store = {'server': server, 'channels': {}}
+
+    for channel in channels:
+        channel_store['channels'].setdefault(channel['_id'], {})
+
+    # The stored tallies are kept by day, so the window starts at the beginning of its first day
+    oldest_date = oldest_date.replace(hour=0, minute=0, second=0, microsecond=0)
+
 formatted_time_period = "{0} - {1}".format(oldest_date.strftime("%m/%d/%Y"), newest_date.strftime("%m/%d/%Y"))
 
-print "=== Rocketchat Statistics For {0} ===\n".format(formatted_time_period)
+report_header = "=== Rocketchat Statistics For {0} ===\n".format(formatted_time_period)
+
+print report_header
 if len(channels) > 0:
-    for channel_index, channel in enumerate(channels):
-        
-        output_file_row_records = []
-
-        channel_history_stats = get_channel_history_stats(session, channel, newest_date, oldest_date)
-
-        formatted_channel_name = "#{0}".format(channel['name'])
-        users_joined = channel_history_stats['statistics']['joined']
-        users_removed = channel_history_stats['statistics']['removed']
-        total_messages = channel_history_stats['statistics']['messages']
-
-        print formatted_channel_name
-        print "  {0} {1} Joined".format(users_joined, plural_items("Users", users_joined))
-        print "  {0} {1} Removed".format(users_removed, plural_items("Users", users_removed))
-        print "  {0} {1}".format(total_messages, plural_items("Messages", total_messages))
-
-        output_file_user_messages = ""
-
-        for username, username_num_messages in sorted(channel_history_stats['messages'].iteritems(), key=lambda (k,v): (v,k), reverse=True):
-            
-            user_messages = "{0} - {1:.2f}% - {2} {3}".format(username, (float(username_num_messages)/float(total_messages)*100), username_num_messages, plural_items("Messages", username_num_messages))
-            
-            print "    * {0}".format(user_messages)
-
-            if output_file_user_messages is not "":
-                output_file_user_messages += "\n"
-            
-            output_file_user_messages += user_messages
-    
-        if output_file is not None:
-            
-            output_file_row_records.append(formatted_channel_name)
-            output_file_row_records.append(formatted_time_period)
-            output_file_row_records.append(users_joined)
-            output_file_row_records.append(total_messages)
-            output_file_row_records.append(output_file_user_messages)
-
-            if channel_index == 0:
-                write_ouput_file_record(output_file, output_file_row_records, True)
-            else:
-                write_ouput_file_record(output_file, output_file_row_records)
+    output_writer = None
+
+    if output_file is not None:
+        output_writer = ChannelReportWriter(output_file, args.output_format, report_header)
+
+    # Channel histories are fetched concurrently, but reported in channel order as they complete
+    pool = ThreadPool(workers)
+    if channel_store is not None:
+        channels_history_stats = pool.imap(lambda channel: get_stored_channel_history_stats(session, channel, newest_date, oldest_date, channel_store['channels'][channel['_id']]), channels)
+    else:
+        channels_history_stats = pool.imap(lambda channel: get_channel_history_stats(session, channel, newest_date, oldest_date), channels)
+
+    for channel, channel_history_stats in izip(channels, channels_history_stats):
+
+        channel_report = build_channel_report(channel, channel_history_stats, formatted_time_period)
+
+        for line in format_channel_report(channel_report):
+            print line
+
+        # Record the users posting in the channel so their activity can be joined with the other collectors
+        if identity_directory is not None:
+            for username in sorted(channel_history_stats['messages'].keys()):
+                identity_directory.record(ROCKETCHAT_SOURCE, username, username)
+
+        if output_writer is not None:
+            output_writer.write(channel_report)
+
+    if output_writer is not None:
+        output_writer.close()
+
+    pool.close()
+    pool.join()
+
+    if channel_store is not None:
+        save_state(args.state_file, channel_store)
 
 else:
     print "No Rocketchat Channels Match the description '{0}'".format(filtered_text)
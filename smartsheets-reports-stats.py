@@ -3,6 +3,7 @@
 import json,argparse,sys,re,os,requests
 from datetime import datetime, timedelta
 from dateutil.relativedelta import relativedelta
+from identity_directory import IdentityDirectory
 
 API_TOKEN_NAME = 'SMARTSHEETS_API_TOKEN'
 DEFAULT_POINTS_GROUPING = "Cards Closed"
@@ -20,12 +21,14 @@ parser.add_argument("-e","--sheet-id", help="The smartsheets sheet id to pull da
 parser.add_argument("-g","--points-grouping", help="Points grouping (ie. Cards Closed)")
 parser.add_argument("-b","--board-id", help="Link back to the original smartsheet")
 parser.add_argument("-c","--channel", help="Points Channel")
+parser.add_argument("--identity-directory", help="SQLite file in which the email addresses of the recipients are recorded")
 args = parser.parse_args()
 start_date = args.start_date
 points_grouping = args.points_grouping
 channel = args.channel
 sheet_id = args.sheet_id
 board_id = args.board_id
+identity_directory = IdentityDirectory(args.identity_directory)
 
 if start_date is None:
     print "Error: Please provide a start date!"
@@ -78,7 +81,7 @@ for r in sheet["rows"]:
             row[field]=get_cell_by_column_name(r,field)["value"]
         
         recipient = row["Verification of Email"]
-        recipient = recipient.replace("@redhat.com","")
+        recipient = identity_directory.record_email(recipient)
         
         if re.search("Thought Leadership.*", row["Program Name"]):
             pool="ThoughtLeadership"
@@ -0,0 +1,91 @@
+# Local state shared between runs of the statistics scripts.
+#
+# State is kept in JSON files which are replaced atomically, so an
+# interrupted run never leaves a partially written file behind.
+
+import atexit, json, os, tempfile, threading, time
+
+CHECKPOINT_INTERVAL = 30
+
+
+def load_state(state_file):
+    if not state_file or not os.path.exists(state_file):
+        return None
+
+    with open(state_file) as f:
+        return json.load(f)
+
+
+def save_state(state_file, state):
+    state_directory = os.path.dirname(os.path.abspath(state_file))
+    fd, temp_file = tempfile.mkstemp(dir=state_directory, prefix=".{0}.".format(os.path.basename(state_file)))
+
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(state, f)
+
+        os.rename(temp_file, state_file)
+    except:
+        os.remove(temp_file)
+        raise
+
+
+class Checkpoint(object):
+    """Progress of a collection pass, periodically saved so it can be resumed
+
+    Progress is grouped in sections, each mapping a key (e.g. a page URL or an
+    item id) to a JSON serializable value. Without a checkpoint file the
+    progress is only kept in memory.
+    """
+
+    def __init__(self, checkpoint_file, signature, resume=False):
+        self.checkpoint_file = checkpoint_file
+        self.lock = threading.RLock()
+        self.saved_at = time.time()
+        self.completed = False
+
+        state = load_state(checkpoint_file) if resume else None
+
+        # A checkpoint taken with different parameters can not be resumed
+        self.resumed = state is not None and state['signature'] == signature
+
+        if not self.resumed:
+            state = {'signature': signature, 'sections': {}}
+
+        self.state = state
+
+        # Also save the progress when the run is aborted by an error
+        atexit.register(self.save)
+
+    def get(self, section, key, default=None):
+        with self.lock:
+            return self.state['sections'].get(section, {}).get(key, default)
+
+    def get_section(self, section):
+        with self.lock:
+            return dict(self.state['sections'].get(section, {}))
+
+    def set(self, section, key, value):
+        with self.lock:
+            self.state['sections'].setdefault(section, {})[key] = value
+
+            if time.time() - self.saved_at >= CHECKPOINT_INTERVAL:
+                self.save()
+
+    def save(self):
+        if self.checkpoint_file is None:
+            return
+
+        with self.lock:
+            if self.completed:
+                return
+
+            save_state(self.checkpoint_file, self.state)
+            self.saved_at = time.time()
+
+    def complete(self):
+        with self.lock:
+            self.completed = True
+
+            if self.checkpoint_file is not None and os.path.exists(self.checkpoint_file):
+                os.remove(self.checkpoint_file)
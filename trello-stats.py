@@ -1,8 +1,12 @@
 #!/usr/bin/env python
 
-import os, json, requests, sys, argparse, collections, re
+import os, json, requests, sys, argparse, collections, re, threading, time
 from datetime import datetime, timedelta
 from dateutil.relativedelta import relativedelta
+from multiprocessing.pool import ThreadPool
+from http_cache import install_http_cache, DEFAULT_HTTP_CACHE_TTL_DAYS
+from state_store import load_state, save_state
+from identity_directory import IdentityDirectory, DEFAULT_IDENTITY_TTL_DAYS, TRELLO_SOURCE
 
 TRELLO_ORG_NAME = 'redhatcop'
 TRELLO_API_KEY_NAME = 'TRELLO_API_KEY'
@@ -12,17 +16,89 @@ DEFAULT_START_DATE_DAY = '01'
 CARD_TITLE_POINTS_REGEX_PATTERN = re.compile(r"\(([0-9]+)\)")
 DEFAULT_POINTS_GROUPING = "Cards Closed"
 
-# Search for cards that are done and have been modified in the past ? days
-TRELLO_SEARCH_QUERY = 'list:Done edited:{0} {1}'
+# Search for cards that are done and have been modified within a window of days
+TRELLO_SEARCH_QUERY = 'list:Done {0} {1}'
+SEARCH_CARDS_LIMIT = 1000
+MAX_SEARCH_CARDS_PAGES = 100
+MAX_BATCH_URLS = 10
+
+# Alternatively, follow the cards moved to the Done list through the board actions
+SEARCH_MODE = 'search'
+ACTIONS_MODE = 'actions'
+DONE_LIST_NAME = 'Done'
+BOARD_ACTIONS_LIMIT = 1000
+
+# Only request the fields that are used (the id is always returned)
+ORG_FIELDS = 'name,displayName'
+MEMBER_FIELDS = 'username,fullName'
+SEARCH_CARD_FIELDS = 'name,idBoard,idMembers,shortLink'
+BOARD_FIELDS = 'name,idOrganization'
+DEFAULT_WORKERS = 4
+
+# Trello allows 100 requests per 10 seconds for each token
+TRELLO_RATE_LIMIT_REQUESTS = 100
+TRELLO_RATE_LIMIT_INTERVAL = 10
+MAX_THROTTLE_RETRIES = 5
 
 debug=False
 memberCache={}
 memberCacheBoards=[]
+identityDirectory=None
 requestCount_org=0
 requestCount_orgMembers=0
 requestCount_member=0  #we need to limit these requests
 requestCount_boardMembers=0
 requestCount_cards=0
+requestCount_batch=0
+requestCount_boards=0
+requestCount_actions=0
+requestCountLock=threading.Lock()
+responseBytes=collections.defaultdict(int)
+
+
+def count_response_bytes(response, *args, **kwargs):
+    # Payload size by endpoint, e.g. /1/boards/<id>/members is counted as boards/members
+    endpoint = "/".join(requests.utils.urlparse(response.url).path.split('/')[2::2])
+    with requestCountLock:
+        responseBytes[endpoint] += len(response.content)
+
+
+class ThrottledSession(requests.Session):
+    """Session spacing requests to stay within the Trello API rate limit"""
+
+    def __init__(self):
+        super(ThrottledSession, self).__init__()
+        self.request_times = collections.deque()
+        self.throttle_lock = threading.Lock()
+
+    def wait_for_request_slot(self):
+        while True:
+            with self.throttle_lock:
+                now = time.time()
+
+                while self.request_times and now - self.request_times[0] >= TRELLO_RATE_LIMIT_INTERVAL:
+                    self.request_times.popleft()
+
+                if len(self.request_times) < TRELLO_RATE_LIMIT_REQUESTS:
+                    self.request_times.append(now)
+                    return
+
+                delay = TRELLO_RATE_LIMIT_INTERVAL - (now - self.request_times[0])
+
+            time.sleep(delay)
+
+    def request(self, method, url, *args, **kwargs):
+        for attempt in range(MAX_THROTTLE_RETRIES + 1):
+            self.wait_for_request_slot()
+            response = super(ThrottledSession, self).request(method, url, *args, **kwargs)
+
+            # The limit is shared with other clients of the same token, so back off when it is exceeded anyway
+            if response.status_code != 429 or attempt == MAX_THROTTLE_RETRIES:
+                return response
+
+            if debug: print "ThrottledSession:: rate limited, retrying {0}".format(url)
+            time.sleep(int(response.headers.get('Retry-After', TRELLO_RATE_LIMIT_INTERVAL)))
+
 
 def valid_date(s):
     try:
@@ -42,31 +118,188 @@ def generate_start_date():
 
 def get_org_id(session):
     #print "org = {0}".format(TRELLO_ORG_NAME)
-    org_request = session.get("https://api.trello.com/1/organizations/{0}".format(TRELLO_ORG_NAME))
+    org_request = session.get("https://api.trello.com/1/organizations/{0}".format(TRELLO_ORG_NAME), params={'fields': ORG_FIELDS})
     global requestCount_org
     requestCount_org+=1
     org_request.raise_for_status()
     return org_request.json()
 
-def search_cards(session, org_id, days, author):
+def search_window_qualifier(window):
+    # A window (newest, oldest) covers cards edited more than newest and at most oldest days ago
+    newest_days, oldest_days = window
+    qualifier = "edited:{0}".format(oldest_days)
+
+    if newest_days > 0:
+        qualifier += " -edited:{0}".format(newest_days)
+
+    return qualifier
+
+def search_cards(session, org_id, window, author, page=0):
     author = "@{0}".format(author) if author is not None else ""
-    query = TRELLO_SEARCH_QUERY.format(days, author)
-    card_request = session.get("https://api.trello.com/1/search", params={'query': query, 'idOrganizations': org_id, 'card_fields': 'name,idBoard,idMembers,idLabels,shortLink', 'board_fields': 'name,idOrganization', 'card_board': 'true', 'cards_limit': 1000})
+    query = TRELLO_SEARCH_QUERY.format(search_window_qualifier(window), author)
+    card_request = session.get("https://api.trello.com/1/search", params={'query': query, 'idOrganizations': org_id, 'modelTypes': 'cards', 'card_fields': SEARCH_CARD_FIELDS, 'board_fields': BOARD_FIELDS, 'card_board': 'true', 'cards_limit': SEARCH_CARDS_LIMIT, 'cards_page': page})
     global requestCount_cards
-    requestCount_cards+=1
+    with requestCountLock:
+        requestCount_cards+=1
     card_request.raise_for_status()
-    return card_request.json()
+    return card_request.json()['cards']
+
+def search_window_pages(pool, session, org_id, window, author, first_page_cards):
+    # Page through a window that can not be split any further, a batch of pages at a time
+    window_cards = list(first_page_cards)
+    page = 1
+
+    while page < MAX_SEARCH_CARDS_PAGES:
+        pages = range(page, min(page + workers, MAX_SEARCH_CARDS_PAGES))
+
+        for page_cards in pool.map(lambda page: search_cards(session, org_id, window, author, page), pages):
+            window_cards.extend(page_cards)
+
+            if len(page_cards) < SEARCH_CARDS_LIMIT:
+                return window_cards, True
+
+        page = pages[-1] + 1
+
+    return window_cards, False
+
+def search_windowed_cards(session, org_id, days, author):
+    # Windows returning a full page are split in two until every window fits in a single page
+    pool = ThreadPool(workers)
+    windows = [(0, days)]
+    windows_cards = {}
+    complete = True
+
+    try:
+        while windows:
+            split_windows = []
+
+            for window, first_page_cards in zip(windows, pool.map(lambda window: search_cards(session, org_id, window, author), windows)):
+                newest_days, oldest_days = window
+
+                if len(first_page_cards) < SEARCH_CARDS_LIMIT:
+                    windows_cards[window] = first_page_cards
+                elif oldest_days - newest_days > 1:
+                    middle_days = (newest_days + oldest_days) // 2
+                    split_windows.extend([(newest_days, middle_days), (middle_days, oldest_days)])
+                else:
+                    windows_cards[window], window_complete = search_window_pages(pool, session, org_id, window, author, first_page_cards)
+                    complete = complete and window_complete
+
+            windows = split_windows
+    finally:
+        pool.close()
+        pool.join()
+
+    if debug: print "search_windowed_cards:: {0} windows".format(len(windows_cards))
+
+    # Most recently edited cards first, as returned by a single search
+    cards = []
+    card_ids = set()
+
+    for window in sorted(windows_cards.keys()):
+        for card in windows_cards[window]:
+            if card['id'] not in card_ids:
+                card_ids.add(card['id'])
+                cards.append(card)
+
+    return cards, complete
 
 def get_member(session, member_id):
-		if member_id not in memberCache:
-		    member_request = session.get("https://api.trello.com/1/members/{0}".format(member_id))
+		if not is_member_cached(member_id):
+		    member_request = session.get("https://api.trello.com/1/members/{0}".format(member_id), params={'fields': MEMBER_FIELDS})
 		    global requestCount_member
 		    requestCount_member+=1
 		    member_request.raise_for_status()
-		    memberCache[member_id]=member_request.json()
-		    if debug: print "get_member:: memberCache.add({0})".format(memberCache[member_id]['username'])
+		    add_member_to_cache(member_request.json())
 		return memberCache.get(member_id)
 
+def is_member_cached(member_id):
+    # Members known from previous runs are taken from the identity directory
+    if member_id not in memberCache:
+        member = identityDirectory.lookup(TRELLO_SOURCE, member_id)
+
+        if member is not None:
+            memberCache[member_id] = member
+
+    return member_id in memberCache
+
+def get_org_boards(session, org_id):
+    boards_request = session.get("https://api.trello.com/1/organizations/{0}/boards".format(org_id), params={'filter': 'all', 'fields': BOARD_FIELDS})
+    global requestCount_boards
+    requestCount_boards+=1
+    boards_request.raise_for_status()
+    return boards_request.json()
+
+def get_board_list_moves(session, board_id, since):
+    # Actions are returned newest first, older pages are requested with the before cursor
+    params = {'filter': 'updateCard:idList', 'fields': 'data,date', 'memberCreator': 'false', 'since': since, 'limit': BOARD_ACTIONS_LIMIT}
+    actions = []
+
+    while True:
+        actions_request = session.get("https://api.trello.com/1/boards/{0}/actions".format(board_id), params=params)
+        global requestCount_actions
+        with requestCountLock:
+            requestCount_actions+=1
+        actions_request.raise_for_status()
+        page_actions = actions_request.json()
+        actions.extend(page_actions)
+
+        if len(page_actions) < BOARD_ACTIONS_LIMIT:
+            break
+
+        params['before'] = page_actions[-1]['id']
+
+    return list(reversed(actions))
+
+def load_card_state(state_file, org_id, start_date):
+    # Actions are only available from the start date of the state, so an earlier start date requires a new state
+    card_state = load_state(state_file) if state_file else None
+
+    if card_state is None or card_state['org_id'] != org_id or card_state['start_date'] > start_date.isoformat():
+        card_state = {'org_id': org_id, 'start_date': start_date.isoformat(), 'boards': {}, 'cards': {}}
+
+    return card_state
+
+def collect_done_cards(session, org_id, start_date, card_state):
+    boards = get_org_boards(session, org_id)
+
+    # Boards are read since their last known action, or since the start date for new boards
+    pool = ThreadPool(workers)
+    try:
+        boards_actions = pool.map(lambda board: get_board_list_moves(session, board['id'], card_state['boards'].get(board['id'], card_state['start_date'])), boards)
+    finally:
+        pool.close()
+        pool.join()
+
+    moved_card_ids = set()
+
+    for board, board_actions in zip(boards, boards_actions):
+        for action in board_actions:
+            card = action['data']['card']
+
+            if action['data']['listAfter']['name'] == DONE_LIST_NAME:
+                card_state['cards'][card['id']] = {'id': card['id'], 'name': card['name'], 'idBoard': board['id'], 'shortLink': card['shortLink'], 'board': {'name': board['name'], 'idOrganization': board['idOrganization']}, 'doneAt': action['date']}
+                moved_card_ids.add(card['id'])
+            elif card['id'] in card_state['cards']:
+                # Cards moved out of Done are no longer credited
+                del card_state['cards'][card['id']]
+
+            card_state['boards'][board['id']] = action['id']
+
+    # The members are not part of the actions, so they are read from the cards moved to Done since the last run
+    # (batch URLs are separated by commas, so only a single field can be requested)
+    card_urls = dict([("/cards/{0}?fields=idMembers".format(card_id), card_id) for card_id in moved_card_ids if card_id in card_state['cards']])
+
+    for card_url, card in get_batched_responses(session, sorted(card_urls.keys())).iteritems():
+        card_state['cards'][card_urls[card_url]]['idMembers'] = card['idMembers']
+
+    if debug: print "collect_done_cards:: {0} boards, {1} cards moved to {2}".format(len(boards), len(moved_card_ids), DONE_LIST_NAME)
+
+    # Most recently completed cards first, as returned by a search
+    done_cards = [card for card in card_state['cards'].values() if card['doneAt'] >= start_date.isoformat()]
+
+    return sorted(done_cards, key=lambda card: (card['doneAt'], card['id']), reverse=True)
+
 def plural_items(text, obj):
     if obj is not None and (isinstance(obj, collections.Iterable) and len(obj) == 1) or obj == 1:
         return text[:-1]
@@ -89,27 +322,65 @@ def encode_text(text):
 
 def preload_member_cache_from_org(session, org_id):
     # Add the organization members
-    members = session.get("https://api.trello.com/1/organizations/{0}/members".format(org_id))
+    members = session.get("https://api.trello.com/1/organizations/{0}/members".format(org_id), params={'fields': MEMBER_FIELDS})
     global requestCount_orgMembers
     requestCount_orgMembers+=1
     members.raise_for_status()
     for member in members.json():
         add_member_to_cache(member)
     
-def preload_member_cache_from_board(session, board_id):
-    # Add the boards members
-    if board_id not in memberCacheBoards:
-        board_members=session.get("https://api.trello.com/1/boards/{0}/members".format(board_id))
-        global requestCount_boardMembers
-        requestCount_boardMembers+=1
-        for member in board_members.json():
+def get_batch(session, urls):
+    # Trello answers each URL of a batch with its own status, e.g. {"200": <response>}
+    batch_request = session.get("https://api.trello.com/1/batch", params={'urls': ",".join(urls)})
+    global requestCount_batch
+    with requestCountLock:
+        requestCount_batch+=1
+    batch_request.raise_for_status()
+    return batch_request.json()
+
+def get_batched_responses(session, urls):
+    # Several batches are requested at the same time, returning the successful responses by URL
+    batches = [urls[index:index + MAX_BATCH_URLS] for index in range(0, len(urls), MAX_BATCH_URLS)]
+    pool = ThreadPool(workers)
+    try:
+        batch_responses = pool.map(lambda batch: get_batch(session, batch), batches)
+    finally:
+        pool.close()
+        pool.join()
+
+    responses = {}
+    for batch, batch_response in zip(batches, batch_responses):
+        for url, response in zip(batch, batch_response):
+            if '200' in response:
+                responses[url] = response['200']
+            elif debug: print "get_batched_responses:: {0} failed: {1}".format(url, response)
+    return responses
+
+def preload_member_cache_from_boards(session, board_ids):
+    # Add the members of all boards not loaded yet, in batches rather than one request per board
+    # (board members are returned with their id, username and fullName only by default)
+    board_urls = dict([("/boards/{0}/members".format(board_id), board_id) for board_id in board_ids if board_id not in memberCacheBoards])
+    responses = get_batched_responses(session, sorted(board_urls.keys()))
+
+    for board_url in sorted(board_urls.keys()):
+        for member in responses.get(board_url, []):
             add_member_to_cache(member)
-        memberCacheBoards.append(board_id)
+        memberCacheBoards.append(board_urls[board_url])
+
+def preload_member_cache_from_members(session, member_ids):
+    # Members that do not belong to any of the boards are looked up in batches as well, get_member remains the fallback
+    # (batch URLs are separated by commas, so these return the full member)
+    member_urls = dict([("/members/{0}".format(member_id), member_id) for member_id in member_ids if not is_member_cached(member_id)])
+    responses = get_batched_responses(session, sorted(member_urls.keys()))
+
+    for member_url, member in responses.iteritems():
+        add_member_to_cache(member)
 
 def add_member_to_cache(member):
     if member['id'] not in memberCache:
         if debug: print "add_member_to_cache:: memberCache.add({0})".format(member['username'])
         memberCache[member['id']] = {"id":member['id'], "username":member['username'], "fullName":member['fullName']}
+        identityDirectory.record(TRELLO_SOURCE, member['id'], member['username'], memberCache[member['id']])
 
 
 
@@ -127,6 +398,13 @@ parser.add_argument("-u","--username", help="Username to query")
 parser.add_argument("-r","--human-readable", action="store_true", help="Human readable format")
 parser.add_argument("-o","--organization", help="Trello organization name")
 parser.add_argument("-p","--points-grouping", help="Points Bucket")
+parser.add_argument("-w","--workers", help="Maximum number of concurrent search requests", type=int, default=DEFAULT_WORKERS)
+parser.add_argument("--mode", help="Find completed cards with a search of recently edited cards, or from the moves to the Done list in the board actions", choices=[SEARCH_MODE, ACTIONS_MODE], default=SEARCH_MODE)
+parser.add_argument("--state-file", help="JSON file used in actions mode to keep the completed cards between runs, so only new actions are read")
+parser.add_argument("--identity-directory", help="SQLite file used to keep the members between runs")
+parser.add_argument("--identity-ttl", help="Days before a member is looked up again", type=int, default=DEFAULT_IDENTITY_TTL_DAYS)
+parser.add_argument("--http-cache", help="SQLite file used to cache responses between runs")
+parser.add_argument("--http-cache-ttl", help="Days before an unvalidated cached response expires", type=int, default=DEFAULT_HTTP_CACHE_TTL_DAYS)
 args = parser.parse_args()
 
 start_date = args.start_date
@@ -145,35 +423,62 @@ if points_grouping is None:
     points_grouping = DEFAULT_POINTS_GROUPING
 
 days = (datetime.now() - start_date).days
+workers = max(1, args.workers)
+identityDirectory = IdentityDirectory(args.identity_directory, args.identity_ttl)
 
-session = requests.Session()
+session = ThrottledSession()
 session.params = {
     'key': trello_api_key,
     'token': trello_api_token,
 }
+session.hooks['response'].append(count_response_bytes)
+
+http_cache = None
+if args.http_cache:
+    http_cache = install_http_cache(session, args.http_cache, args.http_cache_ttl, pool_connections=workers, pool_maxsize=workers)
+else:
+    session.mount('https://', requests.adapters.HTTPAdapter(pool_connections=workers, pool_maxsize=workers))
 
 org_response = get_org_id(session)
 org_id = org_response['id']
 
-resp_cards = search_cards(session, org_id, days, username)
+if args.mode == ACTIONS_MODE:
+    card_state = load_card_state(args.state_file, org_id, start_date)
+    resp_cards = collect_done_cards(session, org_id, start_date, card_state)
+    search_complete = True
+
+    if args.state_file:
+        save_state(args.state_file, card_state)
+else:
+    resp_cards, search_complete = search_windowed_cards(session, org_id, days, username)
+
+if not search_complete:
+    print >> sys.stderr, "# Warning: Trello search results are incomplete, some cards edited on the same day were not returned"
 
 cards = {}
 members_items = {}
 
-preload_member_cache_from_org(session, org_id)
+org_cards = [card for card in resp_cards if card['board']['idOrganization'] and card['board']['idOrganization'] == org_id]
 
-for card in resp_cards['cards']:
-    
-    if not card['board']['idOrganization'] or card['board']['idOrganization'] != org_id:
-        continue 
+# Only members missing from the identity directory need to be loaded
+missing_member_cards = [card for card in org_cards if not all([is_member_cached(member_id) for member_id in card.get('idMembers', [])])]
+
+if missing_member_cards:
+    preload_member_cache_from_org(session, org_id)
+
+    # pre-load the members from the boards of all cards (because that's more efficient than loading members one-by-one later on)
+    preload_member_cache_from_boards(session, set([card['idBoard'] for card in missing_member_cards]))
+    preload_member_cache_from_members(session, set([member_id for card in missing_member_cards for member_id in card.get('idMembers', [])]))
+
+# Like the search for @username, only keep the cards the user is a member of
+if args.mode == ACTIONS_MODE and username is not None:
+    org_cards = [card for card in org_cards if username in [get_member(session, member_id)['username'] for member_id in card.get('idMembers', [])]]
+
+for card in org_cards:
     
     card_id = card['id']
     cards[card_id] = card
     
-    # pre-load the members from the board this card belongs to (because that's more efficient than loading members one-by-one later on)
-    preload_member_cache_from_board(session, card['idBoard'])
-    
-    
     if 'idMembers' in card:
         for member in card['idMembers']:
            
@@ -210,4 +515,8 @@ if (human_readable):
         for card in value['cards']:
             print "   - Board: {0} | Card: {1}".format(encode_text(cards[card]['board']['name']), encode_text(cards[card]['name']))
 
-if debug: print "REQUESTS: org={0}, orgMembers={1}, member={2}, boardMembers={3}, cards={4}".format(requestCount_org, requestCount_orgMembers, requestCount_member, requestCount_boardMembers, requestCount_cards)
+print >> sys.stderr, "{0}: {1} cards, {2}".format(args.mode.capitalize(), len(resp_cards), "complete" if search_complete else "incomplete")
+print >> sys.stderr, "Response bytes: {0} ({1})".format(sum(responseBytes.values()), ", ".join(["{0}={1}".format(endpoint, size) for endpoint, size in sorted(responseBytes.items())]))
+
+if debug: print "REQUESTS: org={0}, orgMembers={1}, member={2}, boardMembers={3}, cards={4}, batch={5}, boards={6}, actions={7}".format(requestCount_org, requestCount_orgMembers, requestCount_member, requestCount_boardMembers, requestCount_cards, requestCount_batch, requestCount_boards, requestCount_actions)
+if debug and http_cache is not None: print "HTTP CACHE: {0}".format(http_cache.cache_usage())